@@ -1,11 +1,47 @@
+import argparse
+import pathlib
+import sys
 import textwrap
 
 import caproto.server
 
+from .calibration import convert_table
 from .rixcalc import Rixcalc
 
 
+def convert_calibration(argv):
+    parser = argparse.ArgumentParser(
+        prog='rixcalc convert-calibration',
+        description=('Convert text bender calibration tables to the binary '
+                     '.npz format.')
+    )
+    parser.add_argument(
+        'tables', nargs='*', type=pathlib.Path,
+        help=('Text tables to convert (default: the tables shipped with '
+              'rixcalc)')
+    )
+    parser.add_argument(
+        '-o', '--output-dir', type=pathlib.Path,
+        help=('Directory for the converted tables (default: next to each '
+              'source)')
+    )
+    args = parser.parse_args(argv)
+
+    tables = args.tables
+    if not tables:
+        directory = pathlib.Path(__file__).resolve().parent
+        tables = sorted(directory.glob('MR*.txt'))
+    for source in tables:
+        destination = None
+        if args.output_dir is not None:
+            destination = args.output_dir / source.with_suffix('.npz').name
+        print(f'{source} -> {convert_table(source, destination)}')
+
+
 def main():
+    if sys.argv[1:2] == ['convert-calibration']:
+        return convert_calibration(sys.argv[2:])
+
     ioc_options, run_options = caproto.server.ioc_arg_parser(
         default_prefix='RIX:CALC:01:',
         desc=textwrap.dedent(Rixcalc.__doc__)
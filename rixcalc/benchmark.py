@@ -0,0 +1,141 @@
+"""
+Timing comparisons for the calculation kernels against their reference
+implementations
+"""
+import pathlib
+import tempfile
+import timeit
+
+import numpy as np
+
+from .calibration import BenderCalibration, convert_table, load_table, read_npz
+from .chemrixs import mr1k1_file, mr3k2_file, mr4k2_file, script_directory
+from .gratings import default_grating
+from .mono_calc import (get_dispersion_geometry, get_lin_disp,
+                        get_lin_disp_array)
+
+
+def _per_call(func, args, number):
+    '''
+    Times func over every argument in args, repeated number times.
+    Returns: Best time per call in seconds
+    '''
+    def run():
+        for arg in args:
+            func(arg)
+    best = min(timeit.repeat(run, number=number, repeat=3))
+    return best / (number * len(args))
+
+
+def benchmark_interpolation(samples=1000, number=10):
+    '''
+    Compares the uniform-grid linear and PCHIP bender lookups with np.interp
+    on the shipped tables.
+    Arguments: Number of random bender positions per table, repetitions
+    Returns: List of (table, column, np.interp time, grid time, PCHIP time,
+             max observed error, error bound)
+    '''
+    rng = np.random.default_rng(0)
+    results = []
+    for path in (mr1k1_file, mr3k2_file, mr4k2_file):
+        q, us, ds = load_table(path)
+        linear = BenderCalibration(q, us, ds, name=path.stem)
+        pchip = BenderCalibration(q, us, ds, name=path.stem, method='pchip')
+        columns = (('US', us, linear.us_to_q, pchip.us_to_q),
+                   ('DS', ds, linear.ds_to_q, pchip.ds_to_q))
+        for column, xp, interpolator, cubic in columns:
+            x = rng.uniform(xp[0], xp[-1], samples)
+            error = np.max(np.abs(interpolator.evaluate(x)
+                                  - np.interp(x, xp, q)))
+            positions = x.tolist()
+            reference = _per_call(
+                lambda v: np.interp(v, xp, q, left=-1, right=-1),
+                positions, number)
+            grid = _per_call(interpolator, positions, number)
+            spline = _per_call(cubic, positions, number)
+            results.append((path.stem, column, reference, grid, spline,
+                            error, interpolator.max_error))
+    return results
+
+
+def benchmark_loading(number=20):
+    '''
+    Compares parsing the text tables with memory-mapping their binary
+    versions, converted into a temporary directory.
+    Arguments: Repetitions
+    Returns: List of (table, text load time, binary load time)
+    '''
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('MR1K1', 'MR3K2', 'MR4K2'):
+            text = script_directory / f'{name}.txt'
+            binary = convert_table(
+                text, pathlib.Path(directory) / f'{name}.npz')
+            reference = min(timeit.repeat(
+                lambda: np.loadtxt(text, unpack=True),
+                number=number, repeat=3))
+            mapped = min(timeit.repeat(lambda: read_npz(binary),
+                                       number=number, repeat=3))
+            results.append((name, reference / number, mapped / number))
+    return results
+
+
+def benchmark_dispersion(samples=1000, number=10):
+    '''
+    Compares the fused dispersion kernel with the get_lin_disp chain over
+    250-1600 eV.
+    Arguments: Number of random energies, repetitions
+    Returns: List of (kernel, reference time, kernel time, max relative
+             difference), times per energy
+    '''
+    rng = np.random.default_rng(0)
+    energies = rng.uniform(250, 1600, samples)
+    dispersion = get_dispersion_geometry(default_grating)
+    reference = np.array([get_lin_disp(energy) for energy in energies])
+    values = energies.tolist()
+
+    chain = _per_call(get_lin_disp, values, number)
+    fused = _per_call(dispersion.lin_disp, values, number)
+    fused_error = max(abs(dispersion.lin_disp(energy)/ref - 1)
+                      for energy, ref in zip(values, reference))
+    array = _per_call(get_lin_disp_array, [energies], number) / samples
+    array_error = np.max(np.abs(get_lin_disp_array(energies)/reference - 1))
+    fused_array = _per_call(dispersion.lin_disp_array, [energies],
+                            number) / samples
+    fused_array_error = np.max(np.abs(
+        dispersion.lin_disp_array(energies)/reference - 1))
+    return [
+        ('fused', chain, fused, fused_error),
+        ('array', chain, array, array_error),
+        ('fused array', chain, fused_array, fused_array_error),
+    ]
+
+
+def main():
+    print('Bender lookup (per call)')
+    print(f"{'table':<6} {'col':<3} {'np.interp':>10} {'grid':>10} "
+          f"{'speedup':>8} {'pchip':>10} {'max err':>10} {'bound':>10}")
+    for (name, column, reference, grid, spline, error,
+         bound) in benchmark_interpolation():
+        print(f'{name:<6} {column:<3} {reference*1e6:8.3f}us '
+              f'{grid*1e6:8.3f}us {reference/grid:7.1f}x '
+              f'{spline*1e6:8.3f}us {error:10.2e} {bound:10.2e}')
+
+    print()
+    print('Table loading (per load)')
+    print(f"{'table':<6} {'loadtxt':>10} {'npz mmap':>10} {'speedup':>8}")
+    for name, reference, mapped in benchmark_loading():
+        print(f'{name:<6} {reference*1e6:8.1f}us {mapped*1e6:8.1f}us '
+              f'{reference/mapped:7.1f}x')
+
+    print()
+    print('Linear dispersion (per energy)')
+    print(f"{'kernel':<12} {'chain':>10} {'kernel':>10} {'speedup':>8} "
+          f"{'max diff':>10}")
+    for name, reference, kernel, error in benchmark_dispersion():
+        print(f'{name:<12} {reference*1e6:8.3f}us {kernel*1e6:8.3f}us '
+              f'{reference/kernel:7.1f}x {error:10.2e}')
+
+
+if __name__ == '__main__':
+    main()
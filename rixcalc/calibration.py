@@ -0,0 +1,645 @@
+"""
+Loading and caching of the bender calibration tables
+"""
+import numpy as np
+import bisect
+import enum
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import struct
+import time
+import zipfile
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Version of the binary table layout written by save_npz
+NPZ_FORMAT_VERSION = 1
+
+
+def load_table(path):
+    '''
+    Reads a bender calibration table from disk.
+    Arguments: Path to a whitespace-delimited text table or a binary .npz table
+    Returns: Focus distance, upstream bender and downstream bender arrays
+    '''
+    if pathlib.Path(path).suffix == '.npz':
+        q, us, ds = read_npz(path)[0]
+    else:
+        q, us, ds = np.loadtxt(path, unpack=True)
+    return q, us, ds
+
+
+def file_sha256(path):
+    '''
+    Returns: Hex SHA-256 digest of the file contents
+    '''
+    return hashlib.sha256(pathlib.Path(path).read_bytes()).hexdigest()
+
+
+def save_npz(path, q, us, ds, name, source_sha256=None):
+    '''
+    Writes a bender calibration table in the binary format.
+
+    The file is an uncompressed zip archive, readable with ``np.load``, so
+    that the table can be memory-mapped straight out of it. It holds a
+    ``table.npy`` array of shape (3, N) with the focus, upstream and
+    downstream columns and a ``metadata.json`` member with the mirror name,
+    the valid range of every column and the digest of the text table it
+    was converted from.
+
+    The format does not speed up IOC startup: for tables of the size used
+    here (about a hundred rows) reading the binary version takes as long as
+    parsing the text, and building the interpolators dominates either way.
+    It saves parsing large tables and gives other tools the validated
+    column ranges without loading the table.
+    Arguments: Destination path, focus, upstream and downstream columns,
+               mirror name, SHA-256 of the source table
+    Returns: None
+    '''
+    table = np.ascontiguousarray([q, us, ds], dtype='<f8')
+    metadata = {
+        'format_version': NPZ_FORMAT_VERSION,
+        'mirror': name,
+        'columns': ['q', 'us', 'ds'],
+        'points': table.shape[1],
+        'source_sha256': source_sha256,
+    }
+    for column, values in zip(metadata['columns'], table):
+        metadata[f'{column}_range'] = [float(values.min()),
+                                       float(values.max())]
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        with archive.open('table.npy', 'w') as member:
+            np.lib.format.write_array(member, table)
+        archive.writestr('metadata.json', json.dumps(metadata))
+
+
+def read_npz(path):
+    '''
+    Opens a binary calibration table without copying it into memory.
+    Arguments: Path to a table written by save_npz
+    Returns: Read-only memory-mapped (3, N) table, metadata dictionary
+    '''
+    with zipfile.ZipFile(path) as archive:
+        metadata = json.loads(archive.read('metadata.json'))
+        info = archive.getinfo('table.npy')
+
+    if metadata.get('format_version') != NPZ_FORMAT_VERSION:
+        raise ValueError(f'{path} has unsupported calibration format '
+                         f'{metadata.get("format_version")}.')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f'{path} is compressed and cannot be memory-mapped.')
+
+    with open(path, 'rb') as f:
+        # Skip the zip local file header to reach the embedded .npy file
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+
+    table = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                      order='F' if fortran_order else 'C')
+    return table, metadata
+
+
+def convert_table(source, destination=None):
+    '''
+    Converts a text calibration table to the binary format.
+    Arguments: Path to the text table, destination path (defaults to the same
+               name with .npz)
+    Returns: Path of the written file
+    '''
+    source = pathlib.Path(source)
+    if destination is None:
+        destination = source.with_suffix('.npz')
+    q, us, ds = load_table(source)
+    # Validate before writing so that a broken table never gets converted
+    BenderCalibration(q, us, ds, name=source.stem)
+    save_npz(destination, q, us, ds, source.stem, file_sha256(source))
+    return pathlib.Path(destination)
+
+
+def resolve_table(path):
+    '''
+    Picks the file to load for a calibration table.
+
+    The binary version written by convert_table is only used while it is
+    newer than its text source and was converted from exactly that text, so
+    editing the text table always takes effect. A binary table without a
+    text source is used as is.
+    Arguments: Path to the table, with either suffix
+    Returns: Path of the text or binary table
+    '''
+    path = pathlib.Path(path)
+    text = path.with_suffix('.txt')
+    binary = path.with_suffix('.npz')
+    if not binary.exists():
+        return text
+    if not text.exists():
+        return binary
+    try:
+        current = binary.stat().st_mtime_ns >= text.stat().st_mtime_ns
+        if current:
+            # Only the metadata member is needed, not the table
+            with zipfile.ZipFile(binary) as archive:
+                metadata = json.loads(archive.read('metadata.json'))
+            current = metadata.get('source_sha256') == file_sha256(text)
+    except Exception:
+        logger.exception('Could not read %s', binary)
+        current = False
+    if not current:
+        logger.info('Ignoring %s, it is out of date with %s', binary, text)
+        return text
+    return binary
+
+
+class RangeStatus(enum.IntEnum):
+    '''
+    Where a looked-up value sits relative to the calibration table.
+    '''
+    OK = 0
+    BELOW_RANGE = 1
+    ABOVE_RANGE = 2
+
+
+class TableInterpolator:
+    '''
+    Lookup of fp(xp) on a calibration table, with xp strictly increasing.
+
+    Validates the table and handles positions outside it. Subclasses build
+    their lookup structures after calling ``__init__`` and implement
+    ``_interpolate`` for one position and ``_evaluate`` for an array of
+    positions, both only ever called inside the table.
+    '''
+
+    def __init__(self, xp, fp):
+        xp = np.asarray(xp, dtype=float)
+        fp = np.asarray(fp, dtype=float)
+        if len(xp) < 2 or len(xp) != len(fp):
+            raise ValueError('Interpolation table needs at least two '
+                             'matching points.')
+        if not np.all(np.diff(xp) > 0):
+            raise ValueError('Interpolation table is not monotonically '
+                             'increasing.')
+        self.xp = xp
+        self.fp = fp
+        self.lower = float(xp[0])
+        self.upper = float(xp[-1])
+
+    def __call__(self, x, fill=np.nan):
+        '''
+        Interpolates a single value.
+        Arguments: Position to look up, value returned when outside the table
+        Returns: Interpolated value
+        '''
+        if not self.lower <= x <= self.upper:
+            return fill
+        return self._interpolate(x)
+
+    def lookup(self, x):
+        '''
+        Interpolates a single value and reports whether it was inside the
+        table.
+        Arguments: Position to look up
+        Returns: Interpolated value (NaN when out of range), RangeStatus
+        '''
+        if x > self.upper:
+            return np.nan, RangeStatus.ABOVE_RANGE
+        if not x >= self.lower:
+            return np.nan, RangeStatus.BELOW_RANGE
+        return self._interpolate(x), RangeStatus.OK
+
+    def evaluate(self, x, fill=np.nan):
+        '''
+        Interpolates an array of values.
+        Arguments: Positions to look up, value used outside the table
+        Returns: Array of interpolated values
+        '''
+        x = np.asarray(x, dtype=float)
+        inside = (x >= self.lower) & (x <= self.upper)
+        values = self._evaluate(np.where(inside, x, self.lower))
+        return np.where(inside, values, fill)
+
+    def _interpolate(self, x):
+        raise NotImplementedError
+
+    def _evaluate(self, x):
+        raise NotImplementedError
+
+
+class UniformGridInterpolator(TableInterpolator):
+    '''
+    Constant-time piecewise-linear lookup of fp(xp).
+
+    The table is resampled onto a uniform grid in x at construction time and
+    the intercept and slope of every grid cell are stored, so a lookup is one
+    index computation and one multiply-add instead of a binary search.
+
+    Resampling only differs from ``np.interp(x, xp, fp)`` inside grid cells
+    that contain one of the original points. Both are piecewise linear, so the
+    largest difference sits on an original point and is measured there
+    exactly. The grid is refined until that difference is at most
+    ``tolerance``; the achieved value is kept in ``max_error``.
+    '''
+
+    def __init__(self, xp, fp, tolerance=1e-4, max_cells=2**22):
+        super().__init__(xp, fp)
+        xp, fp = self.xp, self.fp
+        span = self.upper - self.lower
+
+        # Start with one cell per smallest table step and refine from there
+        cells = int(np.ceil(span / np.diff(xp).min()))
+        while True:
+            nodes = np.linspace(self.lower, self.upper, cells + 1)
+            values = np.interp(nodes, xp, fp)
+            slopes = np.diff(values) / np.diff(nodes)
+            intercepts = values[:-1] - slopes * nodes[:-1]
+
+            self.cells = cells
+            self.inv_step = cells / span
+            self.slopes = slopes
+            self.intercepts = intercepts
+            self.max_error = float(np.max(np.abs(self.evaluate(xp) - fp)))
+            if self.max_error <= tolerance or 2 * cells > max_cells:
+                break
+            cells *= 2
+
+        # Python floats are much faster than numpy scalars for single lookups
+        self._slopes = slopes.tolist()
+        self._intercepts = intercepts.tolist()
+
+    def _interpolate(self, x):
+        i = min(int((x - self.lower) * self.inv_step), self.cells - 1)
+        return self._intercepts[i] + self._slopes[i] * x
+
+    def _evaluate(self, x):
+        i = ((x - self.lower) * self.inv_step).astype(int)
+        np.minimum(i, self.cells - 1, out=i)
+        return self.intercepts[i] + self.slopes[i] * x
+
+
+def _pchip_slopes(h, delta):
+    '''
+    Fritsch-Butland derivatives at the table points, as used by SciPy's
+    PchipInterpolator.
+    '''
+    d = np.zeros(len(h) + 1)
+    if len(h) == 1:
+        d[:] = delta[0]
+        return d
+
+    # Weighted harmonic mean of neighbouring secants, zero at local extrema
+    w1 = 2*h[1:] + h[:-1]
+    w2 = h[1:] + 2*h[:-1]
+    same_sign = delta[:-1]*delta[1:] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = (w1/delta[:-1] + w2/delta[1:]) / (w1 + w2)
+        d[1:-1] = np.where(same_sign, 1/inverse, 0.0)
+
+    def edge(h0, h1, m0, m1):
+        d = ((2*h0 + h1)*m0 - h0*m1) / (h0 + h1)
+        if np.sign(d) != np.sign(m0):
+            return 0.0
+        if np.sign(m0) != np.sign(m1) and abs(d) > abs(3*m0):
+            return 3*m0
+        return d
+
+    d[0] = edge(h[0], h[1], delta[0], delta[1])
+    d[-1] = edge(h[-1], h[-2], delta[-1], delta[-2])
+    return d
+
+
+class PchipInterpolator(TableInterpolator):
+    '''
+    Constant-time monotone cubic (PCHIP) lookup of fp(xp).
+
+    The cubic coefficients of every table segment are computed once at
+    construction time. A uniform grid of cells no wider than the shortest
+    segment maps a position to its segment with one index computation and at
+    most one comparison, so a lookup is a fixed-cost Horner evaluation. The
+    curve passes through every table point and, unlike the linear lookup, has
+    a continuous first derivative.
+    '''
+
+    def __init__(self, xp, fp):
+        super().__init__(xp, fp)
+        xp, fp = self.xp, self.fp
+        span = self.upper - self.lower
+
+        h = np.diff(xp)
+        delta = np.diff(fp) / h
+        d = _pchip_slopes(h, delta)
+        self.coefficients = np.stack([
+            fp[:-1],
+            d[:-1],
+            (3*delta - 2*d[:-1] - d[1:]) / h,
+            (d[:-1] + d[1:] - 2*delta) / h**2,
+        ])
+
+        # Cells narrower than any segment hold at most one table point each
+        self.cells = 2 * int(np.ceil(span / h.min()))
+        self.inv_step = self.cells / span
+        nodes = self.lower + np.arange(self.cells) / self.inv_step
+        self.cell_segment = np.clip(
+            np.searchsorted(xp, nodes, side='right') - 1, 0, len(h) - 1)
+
+        self._knots = xp.tolist()
+        self._cell_segment = self.cell_segment.tolist()
+        self._coefficients = self.coefficients.T.tolist()
+        self._last = len(h) - 1
+        self.max_error = float(np.max(np.abs(self.evaluate(xp) - fp)))
+
+    def _interpolate(self, x):
+        cell = min(int((x - self.lower) * self.inv_step), self.cells - 1)
+        k = self._cell_segment[cell]
+        if k < self._last and x >= self._knots[k + 1]:
+            k += 1
+        c0, c1, c2, c3 = self._coefficients[k]
+        t = x - self._knots[k]
+        return c0 + t*(c1 + t*(c2 + t*c3))
+
+    def _evaluate(self, x):
+        i = ((x - self.lower) * self.inv_step).astype(int)
+        np.minimum(i, self.cells - 1, out=i)
+        k = self.cell_segment[i]
+        k += ((k < self._last)
+              & (x >= self.xp[np.minimum(k + 1, self._last)]))
+        c0, c1, c2, c3 = self.coefficients[:, k]
+        t = x - self.xp[k]
+        return c0 + t*(c1 + t*(c2 + t*c3))
+
+
+class SearchInterpolator(TableInterpolator):
+    '''
+    Piecewise-linear lookup of fp(xp) by binary search, O(log n) per lookup.
+
+    Gives the ``np.interp`` result without resampling the table, so building
+    it costs nothing beyond copying the table. Used where a uniform grid
+    would need very many cells, e.g. the reverse focus-to-bender lookups of
+    tables with widely varying steps.
+    '''
+
+    def __init__(self, xp, fp):
+        super().__init__(xp, fp)
+        self.max_error = 0.0
+        self._xp = self.xp.tolist()
+        self._fp = self.fp.tolist()
+        self._last = len(self._xp) - 2
+
+    def _interpolate(self, x):
+        k = min(bisect.bisect_right(self._xp, x) - 1, self._last)
+        x0 = self._xp[k]
+        f0 = self._fp[k]
+        slope = (self._fp[k + 1] - f0) / (self._xp[k + 1] - x0)
+        return f0 + slope * (x - x0)
+
+    def _evaluate(self, x):
+        return np.interp(x, self.xp, self.fp)
+
+
+class BenderCalibration:
+    '''
+    Bender calibration of one mirror, mapping bender positions to focus
+    distance and back.
+
+    Both bender columns must increase monotonically with the focus distance.
+    With the default ``method='linear'`` the bender-to-focus lookups use
+    ``UniformGridInterpolator``, and stay within ``tolerance`` (in focus
+    units, default 1e-4) of the ``np.interp`` result on the raw table;
+    ``max_error`` reports the bound actually achieved. The focus-to-bender
+    lookups only serve setpoint requests and use ``SearchInterpolator``,
+    which needs no grid. ``method='pchip'``
+    uses ``PchipInterpolator`` instead, which avoids the kinks of linear
+    interpolation on coarse tables.
+    '''
+
+    def __init__(self, q, us, ds, name=None, tolerance=1e-4, sha256=None,
+                 method='linear'):
+        if method == 'linear':
+            interpolator = functools.partial(UniformGridInterpolator,
+                                             tolerance=tolerance)
+            reverse = SearchInterpolator
+        elif method == 'pchip':
+            interpolator = reverse = PchipInterpolator
+        else:
+            raise ValueError(f'Unknown interpolation method {method!r}.')
+
+        self.name = name
+        self.method = method
+        # Identify the table version for the IOC; set from the file contents
+        # by from_file
+        self.sha256 = sha256
+        self.loaded_at = time.time()
+        self.q = np.asarray(q, dtype=float)
+        self.us = np.asarray(us, dtype=float)
+        self.ds = np.asarray(ds, dtype=float)
+        if not np.all(np.diff(self.q) > 0):
+            raise ValueError(f'{name} focus column is not monotonically '
+                             'increasing.')
+
+        self.us_to_q = interpolator(self.us, self.q)
+        self.ds_to_q = interpolator(self.ds, self.q)
+        # Reverse indexes for turning a requested focus into bender setpoints
+        self.q_to_us = reverse(self.q, self.us)
+        self.q_to_ds = reverse(self.q, self.ds)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        '''
+        Builds a calibration from a table on disk, named after the file.
+        A binary table is copied out of its memory map, so that rewriting
+        the file cannot affect a calibration in use.
+        Arguments: Path to the calibration table
+        Returns: BenderCalibration
+        '''
+        path = pathlib.Path(path)
+        kwargs.setdefault('sha256', file_sha256(path))
+        if path.suffix == '.npz':
+            table, metadata = read_npz(path)
+            q, us, ds = np.array(table)
+            kwargs.setdefault('name', metadata['mirror'])
+        else:
+            q, us, ds = load_table(path)
+            kwargs.setdefault('name', path.stem)
+        return cls(q, us, ds, **kwargs)
+
+    @property
+    def max_error(self):
+        return max(self.us_to_q.max_error, self.ds_to_q.max_error,
+                   self.q_to_us.max_error, self.q_to_ds.max_error)
+
+
+class CalibrationCache:
+    '''
+    Keeps parsed calibration tables in memory, keyed by file path.
+
+    Each lookup only stats the file; the table is parsed again only when the
+    modification time or size of the file changed since it was last loaded.
+    The ``hits`` and ``misses`` counters tell how many lookups were served
+    from memory and how many had to go back to the file.
+    '''
+
+    def __init__(self, loader=load_table):
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+
+    def get(self, path):
+        '''
+        Returns the loaded table for path, parsing it only if it is new or
+        changed.
+        Arguments: Path to the calibration file
+        Returns: Whatever the cache loader returns for that file
+        '''
+        path = pathlib.Path(path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        logger.info('Loading calibration table %s', path)
+        value = self.loader(path)
+        self._entries[path] = (signature, value)
+        return value
+
+    def clear(self):
+        '''
+        Drops every cached table and resets the counters.
+        '''
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def find_calibrations(directories, mirrors):
+    '''
+    Finds the calibration tables available for each mirror.
+
+    ``<MIRROR>.txt`` is the ``default`` calibration of a mirror and
+    ``<MIRROR>_<ID>.txt`` an alternative one called ``<ID>``. A binary .npz
+    table is used instead of the text table with the same name when
+    resolve_table finds it up to date, and later directories take
+    precedence over earlier ones.
+    Arguments: Directories to search, mirror names
+    Returns: Dictionary of (mirror, calibration ID) to path
+    '''
+    found = {}
+    for directory in directories:
+        directory = pathlib.Path(directory)
+        stems = sorted({path.stem for suffix in ('.txt', '.npz')
+                        for path in directory.glob(f'*{suffix}')})
+        for stem in stems:
+            for mirror in mirrors:
+                if stem == mirror:
+                    cal_id = 'default'
+                elif stem.startswith(f'{mirror}_'):
+                    cal_id = stem[len(mirror) + 1:]
+                else:
+                    continue
+                found[(mirror, cal_id)] = resolve_table(
+                    directory / f'{stem}.txt')
+    return found
+
+
+class CalibrationRegistry:
+    '''
+    Every loaded calibration, indexed by mirror and calibration ID.
+
+    All tables are held in memory, so making a different calibration active
+    with ``select`` only swaps the entry in ``active`` and never touches the
+    disk. ``active`` maps each mirror to the calibration in use.
+    '''
+
+    def __init__(self):
+        self.tables = {}
+        self.paths = {}
+        self.active = {}
+        self.active_ids = {}
+
+    def add(self, mirror, cal_id, calibration, path=None):
+        '''
+        Registers a calibration, replacing the one with the same ID.
+        The first calibration of a mirror, or a replaced active one, becomes
+        active.
+        '''
+        self.tables.setdefault(mirror, {})[cal_id] = calibration
+        if path is not None:
+            self.paths[(mirror, cal_id)] = pathlib.Path(path)
+        if self.active_ids.get(mirror, cal_id) == cal_id:
+            self.active[mirror] = calibration
+            self.active_ids[mirror] = cal_id
+
+    def select(self, mirror, cal_id):
+        '''
+        Makes a registered calibration the active one for its mirror.
+        Arguments: Mirror name, calibration ID
+        Returns: The newly active calibration
+        '''
+        try:
+            calibration = self.tables[mirror][cal_id]
+        except KeyError:
+            raise ValueError(
+                f'No calibration {cal_id!r} for {mirror}.') from None
+        self.active[mirror] = calibration
+        self.active_ids[mirror] = cal_id
+        return calibration
+
+    def ids(self, mirror):
+        '''
+        Returns: Calibration IDs registered for mirror
+        '''
+        return sorted(self.tables.get(mirror, {}))
+
+    def load(self, paths, loader):
+        '''
+        Loads every calibration file, logging and skipping the ones that fail.
+        The ``default`` calibration of each mirror is made active.
+        Arguments: Dictionary of (mirror, calibration ID) to path, loader
+                   function
+        '''
+        for (mirror, cal_id), path in paths.items():
+            try:
+                calibration = loader(path)
+            except Exception:
+                logger.exception('Could not load %s calibration %r from %s',
+                                 mirror, cal_id, path)
+                continue
+            self.add(mirror, cal_id, calibration, path)
+        for mirror in self.tables:
+            if 'default' in self.tables[mirror]:
+                self.select(mirror, 'default')
+
+    def reload(self, loader):
+        '''
+        Builds a new registry from the same files, keeping the active
+        selections.
+        Arguments: Loader function
+        Returns: CalibrationRegistry
+        '''
+        registry = CalibrationRegistry()
+        registry.load(self.paths, loader)
+        for mirror, cal_id in self.active_ids.items():
+            if cal_id in registry.tables.get(mirror, {}):
+                registry.select(mirror, cal_id)
+        return registry
+
+
+# Shared cache used by the focus calculations
+calibration_cache = CalibrationCache(loader=BenderCalibration.from_file)
@@ -1,102 +1,551 @@
 import numpy as np
+import enum
+import functools
+import math
 import time
 import os
 import pathlib
 
+from .calibration import calibration_cache, resolve_table
+from .gratings import default_grating, gratings
+
 import logging
 logger = logging.getLogger(__name__)
 
 script_directory = pathlib.Path(__file__).resolve().parent
 
-mr1k1_file = script_directory / "MR1K1.txt"
-mr3k2_file = script_directory / "MR3K2.txt"
-mr4k2_file = script_directory / "MR4K2.txt"
 
-def get_KBs(usH0, dsH0, usV0, dsV0):
+def find_table(name):
+    '''
+    Locates a shipped bender table, preferring an up-to-date binary version
+    written by `rixcalc convert-calibration` over the text source.
+    Arguments: Mirror name
+    Returns: Path to the table
+    '''
+    return resolve_table(script_directory / f"{name}.txt")
+
+
+mr1k1_file = find_table("MR1K1")
+mr3k2_file = find_table("MR3K2")
+mr4k2_file = find_table("MR4K2")
+
+calibration_files = {
+    "MR1K1": mr1k1_file,
+    "MR3K2": mr3k2_file,
+    "MR4K2": mr4k2_file,
+}
+
+# Directories searched for calibrations: the shipped tables, then any listed
+# in RIXCALC_CALIBRATION_PATH (separated like PATH)
+calibration_dirs = [script_directory] + [
+    pathlib.Path(directory)
+    for directory
+    in os.environ.get("RIXCALC_CALIBRATION_PATH", "").split(os.pathsep)
+    if directory
+]
+
+# ChemRIXS distance from MR3K2 and MR4K2
+mr3k2_distance = 8.8
+mr4k2_distance = 7.3
+
+
+class FocusOutput(enum.Enum):
+    '''
+    Which bender a focus position is derived from.
+    '''
+    UPSTREAM = 'upstream'
+    DOWNSTREAM = 'downstream'
+    AVERAGE = 'average'
+
+
+def calc_focus(calibration, us, ds, output, distance=0.0):
+    '''
+    Calculates a single focus output of one mirror, interpolating only the
+    bender(s) it needs. The bender that is not needed may be None.
+    Arguments: Mirror calibration, upstream position, downstream position,
+               FocusOutput, distance subtracted from the focus (e.g.
+               mr3k2_distance for the ChemRIXS IP)
+    Returns: Focus position (NaN when out of range), RangeStatus
+    '''
+    if output is FocusOutput.DOWNSTREAM:
+        q, status = calibration.ds_to_q.lookup(ds)
+    elif output is FocusOutput.UPSTREAM:
+        q, status = calibration.us_to_q.lookup(us)
+    elif output is FocusOutput.AVERAGE:
+        q1, q1_status = calibration.us_to_q.lookup(us)
+        q2, q2_status = calibration.ds_to_q.lookup(ds)
+        q = 0.5*(q1 + q2)
+        status = q1_status or q2_status
+    else:
+        raise ValueError(f'Unknown focus output {output!r}.')
+    return q - distance, status
+
+
+def calc_KBs(usH0, dsH0, usV0, dsV0, mr3k2=None, mr4k2=None):
+    '''
+    Calculates the focus position from ChemRIXS IP without raising on
+    out-of-range benders. Range checks are made against the calibration
+    table bounds.
+    Arguments: MR3K2 Upstream, MR3K2 Downstream, MR4K2 Upstream,
+               MR4K2 Downstream, optional MR3K2 and MR4K2 calibrations
+               (default: the shipped tables)
+    Returns: Upstream and Downstream horizontal focus, Upstream and
+             Downstream vertical focus (NaN when out of range), and a
+             RangeStatus for each of them
+    '''
+
+    # bender tables for MR3K2 and MR4K2
+    calH = mr3k2 if mr3k2 is not None else calibration_cache.get(mr3k2_file)
+    calV = mr4k2 if mr4k2 is not None else calibration_cache.get(mr4k2_file)
+    dH = mr3k2_distance
+    dV = mr4k2_distance
+
+    hor0, hor0_status = calH.us_to_q.lookup(usH0)
+    hor1, hor1_status = calH.ds_to_q.lookup(dsH0)
+    ver0, ver0_status = calV.us_to_q.lookup(usV0)
+    ver1, ver1_status = calV.ds_to_q.lookup(dsV0)
+
+    final_up_h = hor0-dH
+    final_ds_h = hor1-dH
+    final_up_v = ver0-dV
+    final_ds_v = ver1-dV
+
+    return ((final_up_h, final_ds_h, final_up_v, final_ds_v),
+            (hor0_status, hor1_status, ver0_status, ver1_status))
+
+
+def get_KBs(usH0, dsH0, usV0, dsV0, mr3k2=None, mr4k2=None):
     '''
     Displays current focus position from ChemRIXS IP.
     Focus position is calculated based on the KBs benders calibration.
-    Arguments: MR3K2 Upstream, MR3K2 Downstream, MR4K2 Upstream, MR4K2 Downstream
+    Arguments: MR3K2 Upstream, MR3K2 Downstream, MR4K2 Upstream,
+               MR4K2 Downstream, optional MR3K2 and MR4K2 calibrations
+               (default: the shipped tables)
     Returns: Upstream and Downstream horizontal focus, Upstream and Downstream vertical focus
     '''
 
-    # bender tables for MR3K2 and MR4K2
-    qH, usH, dsH = np.loadtxt(mr3k2_file, unpack=True)
-    qV, usV, dsV = np.loadtxt(mr4k2_file, unpack=True)
-    # ChemRIXS distance from MR3K2 and MR4K2
-    dH = 8.8
-    dV = 7.3
-
-    hor0 = np.interp(usH0, usH, qH, left=-1, right=-1)
-    hor1 = np.interp(dsH0, dsH, qH, left=-1, right=-1)
-    ver0 = np.interp(usV0, usV, qV, left=-1, right=-1)
-    ver1 = np.interp(dsV0, dsV, qV, left=-1, right=-1)
-
-    if hor0<0:
+    focus, status = calc_KBs(usH0, dsH0, usV0, dsV0, mr3k2, mr4k2)
+
+    if status[0]:
         raise Exception('Horizontal KB upstream bender value is out of range.')
-    if hor1<0:
+    if status[1]:
         raise Exception('Horizontal KB downstream bender value is out of range.')
-    if ver0<0:
+    if status[2]:
         raise Exception('Vertical KB upstream bender value out is of range.')
-    if ver1<0:
+    if status[3]:
         raise Exception('Vertical KB downstream bender value is out of range.')
 
-    final_up_h = hor0-dH
-    final_ds_h = hor1-dH
-    final_up_v = ver0-dV
-    final_ds_v = ver1-dV
+    return focus
+
+
+def _scalars(*values):
+    '''
+    Whether all values are plain finite numbers, for which math is used
+    instead of NumPy.
+    '''
+    for value in values:
+        if type(value) not in (float, int, np.float64) or \
+                not math.isfinite(value):
+            return False
+    return True
+
+
+class MonoGeometry:
+    '''
+    Photon energy model of the SP1K1 mono, with its constants folded
+    together once.
+
+    The grating angles alpha = pi/2 - pG + 2*pM2 - thetaM1 and
+    beta = -pi/2 - pG + thetaES, with pG = G_PI*1e-6 - offsetG and
+    pM2 = M_PI*1e-6 - offsetM2, are linear in the pitches. The offsets are
+    folded into alpha0 and beta0, so alpha = alpha0 + 1e-6*(2*M_PI - G_PI)
+    and beta = beta0 - 1e-6*G_PI. The different rounding puts energies and
+    Cff within ~1e-11 relative of the original get_E chain. All methods
+    accept scalars or NumPy arrays of pitches (in urad) and broadcast them;
+    plain numbers are evaluated with math, which is much faster than NumPy
+    for a single pair of pitches.
+    '''
+
+    def __init__(self, D0=50.0, offsetG=63358.0e-6, offsetM2=90641.0e-6,
+                 thetaM1=0.03662, thetaES=0.1221413, m=1, eVmm=0.001239842):
+        self.D0 = D0  # 1/mm
+        self.offsetG = offsetG  # rad
+        self.offsetM2 = offsetM2  # rad
+        self.thetaM1 = thetaM1  # rad
+        self.thetaES = thetaES  # rad
+        self.m = m  # diffraction order
+        self.eVmm = eVmm  # Wavelength[mm] = eVmm/Energy[eV]
+
+        self.energy_scale = m*D0*eVmm
+        self.alpha0 = np.pi/2 + offsetG - 2*offsetM2 - thetaM1
+        self.beta0 = -np.pi/2 + offsetG + thetaES
+
+    @classmethod
+    def from_grating(cls, grating, **kwargs):
+        '''
+        Builds the energy model for one entry of the grating table.
+        Arguments: Grating, optional overrides of the remaining constants
+        Returns: MonoGeometry
+        '''
+        return cls(D0=grating.groove_density, offsetG=grating.offset_g,
+                   offsetM2=grating.offset_m2, **kwargs)
+
+    def angles(self, pitchG, pitchM2):
+        '''
+        Grating incidence and diffraction angles.
+        Arguments: Mono G Pi, Mono M Pi (urad)
+        Returns: alpha, beta (rad)
+        '''
+        pitchG = np.asarray(pitchG, dtype=float)
+        pitchM2 = np.asarray(pitchM2, dtype=float)
+        alpha = self.alpha0 + 1e-6*(2*pitchM2 - pitchG)
+        beta = self.beta0 - 1e-6*pitchG
+        return alpha, beta
+
+    def _scalar_energy_cff(self, pitchG, pitchM2):
+        # Same arithmetic as angles/energy_cff for plain numbers
+        alpha = self.alpha0 + 1e-6*(2*pitchM2 - pitchG)
+        beta = self.beta0 - 1e-6*pitchG
+        E = self.energy_scale/(math.sin(alpha) + math.sin(beta))
+        Cff = math.cos(beta)/math.cos(alpha)
+        return E, Cff
+
+    def energy(self, pitchG, pitchM2):
+        '''
+        Photon energy for grating and pre-mirror pitches.
+        Arguments: Mono G Pi, Mono M Pi (urad)
+        Returns: Photon energy (eV)
+        '''
+        if _scalars(pitchG, pitchM2):
+            alpha = self.alpha0 + 1e-6*(2*pitchM2 - pitchG)
+            beta = self.beta0 - 1e-6*pitchG
+            return self.energy_scale/(math.sin(alpha) + math.sin(beta))
+        alpha, beta = self.angles(pitchG, pitchM2)
+        return self.energy_scale/(np.sin(alpha) + np.sin(beta))
+
+    def energies(self, pitchG, pitchG_target, pitchM2, pitchM2_target):
+        '''
+        Current and target photon energy, evaluated together in one pass.
+        Arguments: Mono G Pi RBV, Mono G Pi, Mono M Pi RBV, Mono M Pi (urad)
+        Returns: Current mono energy, target mono energy
+        '''
+        if _scalars(pitchG, pitchG_target, pitchM2, pitchM2_target):
+            return (self.energy(pitchG, pitchM2),
+                    self.energy(pitchG_target, pitchM2_target))
+        pitchG, pitchG_target, pitchM2, pitchM2_target = np.broadcast_arrays(
+            pitchG, pitchG_target, pitchM2, pitchM2_target)
+        E = self.energy(np.stack([pitchG, pitchG_target]),
+                        np.stack([pitchM2, pitchM2_target]))
+        return E[0], E[1]
+
+    def energy_orders(self, pitchG, pitchM2, orders):
+        '''
+        Photon energies passed in several diffraction orders at the same
+        pitches.
+        Arguments: Mono G Pi, Mono M Pi (urad), diffraction orders
+        Returns: Photon energies (eV), with a trailing axis over the orders
+        '''
+        alpha, beta = self.angles(pitchG, pitchM2)
+        first_order = self.D0*self.eVmm/(np.sin(alpha) + np.sin(beta))
+        return np.multiply.outer(first_order, np.asarray(orders, dtype=float))
+
+    def energy_cff(self, pitchG, pitchM2):
+        '''
+        Photon energy and fixed-focus constant Cff = cos(beta)/cos(alpha)
+        from the same angles.
+        Arguments: Mono G Pi, Mono M Pi (urad)
+        Returns: Photon energy (eV), Cff
+        '''
+        if _scalars(pitchG, pitchM2):
+            return self._scalar_energy_cff(pitchG, pitchM2)
+        alpha, beta = self.angles(pitchG, pitchM2)
+        E = self.energy_scale/(np.sin(alpha) + np.sin(beta))
+        Cff = np.cos(beta)/np.cos(alpha)
+        return E, Cff
+
+    def energies_cff(self, pitchG, pitchG_target, pitchM2, pitchM2_target):
+        '''
+        Current and target photon energy and Cff, evaluated together in one
+        pass.
+        Arguments: Mono G Pi RBV, Mono G Pi, Mono M Pi RBV, Mono M Pi (urad)
+        Returns: Current mono energy, target mono energy, current Cff,
+                 target Cff
+        '''
+        if _scalars(pitchG, pitchG_target, pitchM2, pitchM2_target):
+            E, Cff = self._scalar_energy_cff(pitchG, pitchM2)
+            E_target, Cff_target = self._scalar_energy_cff(pitchG_target,
+                                                           pitchM2_target)
+            return E, E_target, Cff, Cff_target
+        pitchG, pitchG_target, pitchM2, pitchM2_target = np.broadcast_arrays(
+            pitchG, pitchG_target, pitchM2, pitchM2_target)
+        E, Cff = self.energy_cff(np.stack([pitchG, pitchG_target]),
+                                 np.stack([pitchM2, pitchM2_target]))
+        return E[0], E[1], Cff[0], Cff[1]
+
+    def pitches(self, energy, cff):
+        '''
+        Grating and pre-mirror pitches that give the requested photon energy
+        at a fixed Cff.
+
+        Written with the grazing angles ta = pi/2 - alpha and tb = pi/2 + beta,
+        the grating equation is cos(ta) - cos(tb) = energy_scale/E with
+        sin(tb) = Cff*sin(ta). This has a closed-form solution, arranged here
+        so that neither cos(ta) nor 1 - cos(ta) cancel, which keeps it exact
+        at small grazing angles and for Cff close to 1. Each solution is
+        checked by putting it back into the equations; requests without an
+        accurate solution (e.g. Cff not above 1) give NaN.
+        Arguments: Photon energy (eV), Cff; scalars or arrays
+        Returns: Mono G Pi, Mono M Pi (urad)
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = self.energy_scale/np.asarray(energy, dtype=float)
+            c = np.asarray(cff, dtype=float)
+            k, c = np.broadcast_arrays(k, c)
+            c2m1 = (c - 1)*(c + 1)
+
+            # x = cos(ta) is a root of (1-c^2)x^2 - 2kx + (k^2-1+c^2) = 0
+            D = np.sqrt(c2m1**2 + c**2*k**2)
+            x = (k**2 + c2m1)/(D + k)
+            one_minus_x = k*(c**2*k/(D + c2m1) + 1 - k)/(D + k)
+            ta = 2*np.arcsin(np.sqrt(one_minus_x/2))
+            # cos(tb) = x - k, negative for the spurious root
+            tb = np.arctan2(c*np.sin(ta), x - k)
+
+            alpha = np.pi/2 - ta
+            beta = tb - np.pi/2
+            energy_error = np.abs((np.sin(alpha) + np.sin(beta))/k - 1)
+            cff_error = np.abs(np.cos(beta)/np.cos(alpha)/c - 1)
+            solved = ((c > 1) & (k > 0) & (x >= k)
+                      & (energy_error < 1e-9) & (cff_error < 1e-9))
 
-    return final_up_h, final_ds_h, final_up_v, final_ds_v
+        pitchG = np.where(solved, (self.beta0 - beta)*1e6, np.nan)
+        pitchM2 = np.where(solved, ((alpha - self.alpha0)*1e6 + pitchG)/2,
+                           np.nan)
+        return pitchG, pitchM2
 
-def get_E(pitchG, pitchG_target, pitchM2, pitchM2_target):
+
+@functools.lru_cache(maxsize=None)
+def get_mono_geometry(grating):
+    '''
+    Energy model of the mono with the named grating, built once per grating.
+    Arguments: Grating name from the grating table
+    Returns: MonoGeometry
+    '''
+    return MonoGeometry.from_grating(gratings[grating])
+
+
+# SP1K1 mono as used by get_E
+mono_geometry = get_mono_geometry(default_grating)
+
+
+class EnergyBranch:
+    '''
+    Photon energy and Cff of one pair of pitches (the RBVs or the setpoints),
+    recomputed only when those pitches or the mono geometry change.
+    '''
+
+    def __init__(self):
+        self.key = None
+        self.energy = None
+        self.cff = None
+        self.evaluations = 0
+        self.skipped = 0
+
+    def update(self, geometry, pitchG, pitchM2):
+        '''
+        Re-evaluates the branch if its inputs differ from the last call.
+        Arguments: MonoGeometry, Mono G Pi, Mono M Pi (urad)
+        Returns: True when the energy and Cff were recomputed
+        '''
+        key = (geometry, pitchG, pitchM2)
+        if key == self.key:
+            self.skipped += 1
+            return False
+        self.energy, self.cff = geometry.energy_cff(pitchG, pitchM2)
+        self.key = key
+        self.evaluations += 1
+        return True
+
+
+def get_E(pitchG, pitchG_target, pitchM2, pitchM2_target, geometry=None):
     '''
     Reports current photon energy and Cff for based on current grating and pre-mirror pitch target and RBV.
     Reports the FEL set energy.
-    Arguments: Mono G Pi RBV, Mono G Pi, Mono M Pi RBV, Mono M Pi
+    Arguments: Mono G Pi RBV, Mono G Pi, Mono M Pi RBV, Mono M Pi, optional
+               MonoGeometry
     Returns:   Current mono energy, target mono energy
     '''
+    if geometry is None:
+        geometry = mono_geometry
+    return geometry.energies(pitchG, pitchG_target, pitchM2, pitchM2_target)
+
+
+def get_E_cff(pitchG, pitchG_target, pitchM2, pitchM2_target, geometry=None):
+    '''
+    Reports current and target photon energy together with the current and
+    target Cff.
+    Arguments: Mono G Pi RBV, Mono G Pi, Mono M Pi RBV, Mono M Pi, optional
+               MonoGeometry
+    Returns:   Current mono energy, target mono energy, current Cff,
+               target Cff
+    '''
+    if geometry is None:
+        geometry = mono_geometry
+    return geometry.energies_cff(pitchG, pitchG_target, pitchM2,
+                                 pitchM2_target)
+
+
+# Largest energy scan plan_energy_scan will produce
+max_scan_points = 10000
 
-    # constants
-    eVmm = 0.001239842 # Wavelenght[mm] = eVmm/Energy[eV]
-    m = 1 # diffraction order
-    D0 = 50.0 # 1/mm
-    thetaM1 = 0.03662 # rad
-    thetaES = 0.1221413 # rad
-    offsetM2 = 90641.0e-6 # rad
-    offsetG = 63358.0e-6 # rad
 
-    # RBV
-    pG = pitchG*1e-6 - offsetG
-    pM2 = pitchM2*1e-6 - offsetM2
-    alpha = np.pi/2 - pG + 2*pM2 - thetaM1
-    beta = -np.pi/2 - pG + thetaES
-    E = m*D0*eVmm/(np.sin(alpha) + np.sin(beta))
-    Cff = np.cos(beta)/np.cos(alpha)
+def plan_energy_scan(start, stop, step, cff, geometry=None):
+    '''
+    Calculates the grating and pre-mirror pitch trajectory of an energy scan
+    at fixed Cff. The scan runs from start towards stop in steps of step,
+    including stop when it falls on the grid.
+    Arguments: Start energy, stop energy, energy step (eV), Cff, optional
+               MonoGeometry
+    Returns: Energies, Mono G Pi, Mono M Pi arrays
+    '''
+    if geometry is None:
+        geometry = mono_geometry
+    if step == 0 or (stop - start)*step < 0:
+        raise ValueError('Energy step must be non-zero and point from start '
+                         'to stop.')
+    # Small allowance so that a stop on the grid is not lost to rounding
+    points = int(np.floor((stop - start)/step + 1e-9)) + 1
+    if points > max_scan_points:
+        raise ValueError(f'Energy scan has {points} points, more than '
+                         f'{max_scan_points}.')
 
-    # target
-    pG_tar = pitchG_target*1e-6 - offsetG
-    pM2_tar = pitchM2_target*1e-6 - offsetM2
-    alpha_tar = np.pi/2 - pG_tar + 2*pM2_tar - thetaM1
-    beta_tar = -np.pi/2 - pG_tar + thetaES
-    E_target = m*D0*eVmm/(np.sin(alpha_tar) + np.sin(beta_tar))
-    Cff_target = np.cos(beta_tar)/np.cos(alpha_tar)
+    energies = start + step*np.arange(points)
+    pitchG, pitchM2 = geometry.pitches(energies, cff)
+    return energies, pitchG, pitchM2
 
-    return E, E_target
 
-def get_benders(mr1k1_us, mr1k1_ds):
+def calc_benders(mr1k1_us, mr1k1_ds, calibration=None):
     '''
-    Calculates MR1K1 benders current focus position.
-    Focus position is calculated based on the MR1K1 benders calibration.
-    Arguments: MR1K1 downstream position, MR1K1 upstream position
-    Returns: None
+    Calculates MR1K1 benders current focus position without raising on
+    out-of-range benders. Range checks are made against the calibration
+    table bounds.
+    Arguments: MR1K1 upstream position, MR1K1 downstream position, optional
+               MR1K1 calibration
+    Returns: MR1K1 focus position (NaN when out of range), RangeStatus
     '''
 
     # bender table for MR1K1
-    qMR1, usMR1, dsMR1 = np.loadtxt(mr1k1_file, unpack=True)
+    calMR1 = calibration
+    if calMR1 is None:
+        calMR1 = calibration_cache.get(mr1k1_file)
+
+    return calc_focus(calMR1, mr1k1_us, mr1k1_ds, FocusOutput.AVERAGE)
+
+
+def get_benders(mr1k1_us, mr1k1_ds, calibration=None):
+    '''
+    Calculates MR1K1 benders current focus position.
+    Focus position is calculated based on the MR1K1 benders calibration.
+    Arguments: MR1K1 downstream position, MR1K1 upstream position, optional
+               MR1K1 calibration
+    Returns: MR1K1 focus position
+    '''
 
-    q1 = np.interp(mr1k1_us, usMR1, qMR1, left=-1, right=-1)
-    q2 = np.interp(mr1k1_ds, dsMR1, qMR1, left=-1, right=-1)
-    if q1<0 or q2<0:
+    q0, status = calc_benders(mr1k1_us, mr1k1_ds, calibration)
+    if status:
         raise Exception('Bender value is out of range.')
-    q0 = 0.5*(q1 + q2)
     return q0
+
+
+def get_KBs_batch(usH0, dsH0, usV0, dsV0, mr3k2=None, mr4k2=None):
+    '''
+    Array version of get_KBs for post-processing recorded bender positions.
+    Uses the same calibrations and arithmetic as get_KBs, so in-range
+    results are identical.
+    Arguments: Arrays of MR3K2 Upstream, MR3K2 Downstream, MR4K2 Upstream,
+               MR4K2 Downstream, optional MR3K2 and MR4K2 calibrations
+               (default: the shipped tables)
+    Returns: Upstream and Downstream horizontal focus, Upstream and
+             Downstream vertical focus, validity mask
+    Outputs are NaN where their bender value is out of range; the mask is
+    True where all four are valid.
+    '''
+
+    calH = mr3k2 if mr3k2 is not None else calibration_cache.get(mr3k2_file)
+    calV = mr4k2 if mr4k2 is not None else calibration_cache.get(mr4k2_file)
+    dH = mr3k2_distance
+    dV = mr4k2_distance
+
+    hor0 = calH.us_to_q.evaluate(usH0)
+    hor1 = calH.ds_to_q.evaluate(dsH0)
+    ver0 = calV.us_to_q.evaluate(usV0)
+    ver1 = calV.ds_to_q.evaluate(dsV0)
+
+    valid = ~(np.isnan(hor0) | np.isnan(hor1)
+              | np.isnan(ver0) | np.isnan(ver1))
+
+    return hor0-dH, hor1-dH, ver0-dV, ver1-dV, valid
+
+
+def get_benders_batch(mr1k1_us, mr1k1_ds, calibration=None):
+    '''
+    Array version of get_benders for post-processing recorded bender positions.
+    Uses the same calibration and arithmetic as get_benders, so in-range
+    results are identical.
+    Arguments: Arrays of MR1K1 upstream position, MR1K1 downstream position,
+               optional MR1K1 calibration
+    Returns: MR1K1 focus position (NaN where out of range), validity mask
+    '''
+
+    calMR1 = calibration
+    if calMR1 is None:
+        calMR1 = calibration_cache.get(mr1k1_file)
+
+    q1 = calMR1.us_to_q.evaluate(mr1k1_us)
+    q2 = calMR1.ds_to_q.evaluate(mr1k1_ds)
+    q0 = 0.5*(q1 + q2)
+    return q0, ~np.isnan(q0)
+
+
+def _get_setpoints(calibration, q, name):
+    us, us_status = calibration.q_to_us.lookup(q)
+    ds, ds_status = calibration.q_to_ds.lookup(q)
+    if us_status or ds_status:
+        raise Exception(f'{name} target focus is out of range.')
+    return us, ds
+
+
+def get_mr1k1_setpoints(focus, calibration=None):
+    '''
+    Calculates the MR1K1 bender positions that put the focus at the
+    requested position.
+    Arguments: Target MR1K1 focus position, optional MR1K1 calibration
+    Returns: MR1K1 upstream position, MR1K1 downstream position
+    '''
+    if calibration is None:
+        calibration = calibration_cache.get(mr1k1_file)
+    return _get_setpoints(calibration, focus, 'MR1K1')
+
+
+def get_mr3k2_setpoints(focus, calibration=None):
+    '''
+    Calculates the MR3K2 bender positions for a horizontal focus relative to
+    the ChemRIXS IP.
+    Arguments: Target horizontal focus position, optional MR3K2 calibration
+    Returns: MR3K2 upstream position, MR3K2 downstream position
+    '''
+    if calibration is None:
+        calibration = calibration_cache.get(mr3k2_file)
+    return _get_setpoints(calibration, focus + mr3k2_distance, 'MR3K2')
+
+
+def get_mr4k2_setpoints(focus, calibration=None):
+    '''
+    Calculates the MR4K2 bender positions for a vertical focus relative to
+    the ChemRIXS IP.
+    Arguments: Target vertical focus position, optional MR4K2 calibration
+    Returns: MR4K2 upstream position, MR4K2 downstream position
+    '''
+    if calibration is None:
+        calibration = calibration_cache.get(mr4k2_file)
+    return _get_setpoints(calibration, focus + mr4k2_distance, 'MR4K2')
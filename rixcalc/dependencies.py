@@ -0,0 +1,79 @@
+"""
+Tracking which calculated outputs are affected by changed inputs
+"""
+import threading
+
+
+class DependencyGraph:
+    '''
+    Maps every input to the outputs calculated from it.
+
+    Outputs are given with the names they depend on, which may be inputs or
+    other outputs. Inputs are marked dirty as they change (from any thread);
+    ``pop_dirty`` then hands over every output downstream of them, ordered so
+    that an output comes after the outputs it depends on.
+    '''
+
+    def __init__(self, dependencies):
+        self.dependencies = {output: tuple(inputs)
+                             for output, inputs in dependencies.items()}
+        self.dependents = {}
+        for output, inputs in self.dependencies.items():
+            for name in inputs:
+                self.dependents.setdefault(name, set()).add(output)
+        self.order = self._sort()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _sort(self):
+        order = []
+        state = {}
+
+        def visit(output):
+            if state.get(output) == 'done':
+                return
+            if state.get(output) == 'visiting':
+                raise ValueError(f'Dependency cycle through {output}.')
+            state[output] = 'visiting'
+            for name in self.dependencies[output]:
+                if name in self.dependencies:
+                    visit(name)
+            state[output] = 'done'
+            order.append(output)
+
+        for output in self.dependencies:
+            visit(output)
+        return order
+
+    def mark_dirty(self, name):
+        '''
+        Records that an input (or an output that must be recomputed) changed.
+        '''
+        with self._lock:
+            self._dirty.add(name)
+
+    def mark_all_dirty(self):
+        '''
+        Records every output as needing a recompute.
+        '''
+        with self._lock:
+            self._dirty.update(self.dependencies)
+
+    def pop_dirty(self):
+        '''
+        Hands over the outputs affected by the names marked since the last
+        call.
+        Returns: List of outputs in dependency order
+        '''
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        affected = set()
+        pending = list(dirty)
+        while pending:
+            name = pending.pop()
+            if name in self.dependencies:
+                affected.add(name)
+            for output in self.dependents.get(name, ()):
+                if output not in affected:
+                    pending.append(output)
+        return [output for output in self.order if output in affected]
@@ -0,0 +1,31 @@
+"""
+Grating parameters of the SP1K1 mono, shared by the energy and dispersion
+calculations
+"""
+from typing import NamedTuple
+
+
+class Grating(NamedTuple):
+    groove_density: float  # Groove density (l/mm)
+    offset_g: float  # Grating pitch offset (rad)
+    offset_m2: float  # Pre-mirror pitch offset (rad)
+    inc_angle: float  # Incidence angle grating (deg)
+    d1: float  # Grating constant?
+    virt_source_dist: float  # Virtual source distance from grating (mm)
+    rad_curv: float  # Radius of curvature (mm)
+
+
+# Add further gratings here; the keys are the choices of the GRATING PV
+gratings = {
+    '50 l/mm': Grating(
+        groove_density=50.0,
+        offset_g=63358.0e-6,
+        offset_m2=90641.0e-6,
+        inc_angle=88.627325,
+        d1=-0.0244,
+        virt_source_dist=-7540.0458,
+        rad_curv=9*(10**99),
+    ),
+}
+
+default_grating = '50 l/mm'
@@ -5,6 +5,10 @@ import numpy as np
 import time
 import os
 import math
+import functools
+
+from .calibration import UniformGridInterpolator
+from .gratings import default_grating, gratings
 
 import logging
 logger = logging.getLogger(__name__)
@@ -42,20 +46,23 @@ def calc_lambda(photon_energy):
     return lambda_calc
 
 
-def get_lin_disp(photon_energy):
+def get_lin_disp(photon_energy, grating=default_grating):
     '''
     Calculates the reciprocal linear dispersion of the monochromator through the exit slit plane
-    Arguments: The photon energy of the beam
+    Arguments: The photon energy of the beam, grating name from the grating
+               table
     Returns: The reciprocal linear dispersion
     '''
 
     # Constants
-    groove_density = 50 # Groove density (l/mm)
-    diff_order = 1 # Diffraction order
-    d1 = -0.0244 # Grating constant?
-    grating_inc_angle = 88.627325 # Incidence angle grating (deg)
-    virt_source_dist = -7540.0458 # Virtual source distance from grating (mm)
-    rad_curv = 9*(10**99) # Radius of curvature (mm)
+    constants = gratings[grating]
+    groove_density = constants.groove_density  # Groove density (l/mm)
+    diff_order = 1  # Diffraction order
+    d1 = constants.d1  # Grating constant?
+    grating_inc_angle = constants.inc_angle  # Incidence angle grating (deg)
+    # Virtual source distance from grating (mm)
+    virt_source_dist = constants.virt_source_dist
+    rad_curv = constants.rad_curv  # Radius of curvature (mm)
 
     Beta = calc_beta(photon_energy,diff_order,groove_density,grating_inc_angle)
     Lambda = calc_lambda(photon_energy)
@@ -68,3 +75,240 @@ def get_lin_disp(photon_energy):
     linear_disp = (a / b) * c * 1000000
     return linear_disp
 
+
+def get_lin_disp_array(photon_energy, grating=default_grating):
+    '''
+    Calculates the reciprocal linear dispersion for an array of photon energies
+    with the same formula as get_lin_disp.
+    Energies for which get_lin_disp fails (no diffracted beam, beta not
+    above 0) give NaN.
+    Arguments: The photon energies of the beam, grating name from the grating
+               table
+    Returns: The reciprocal linear dispersion
+    '''
+    constants = gratings[grating]
+    groove_density = constants.groove_density
+    diff_order = 1
+    grating_inc_angle = math.radians(constants.inc_angle)
+    cos_grating_inc_angle = math.cos(grating_inc_angle)
+
+    photon_energy = np.asarray(photon_energy, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # calc_beta
+        sin_beta = (-(diff_order) * (1239.852 / photon_energy)
+                    * (groove_density / 1000000)
+                    + math.sin(grating_inc_angle))
+        valid = (sin_beta < 1) & (sin_beta >= -1)
+        Beta = np.where(valid, np.arcsin(np.where(valid, sin_beta, 0.0)),
+                        np.nan)
+        valid &= Beta > 0
+        cos_Beta = np.cos(Beta)
+
+        # calc_r_prime
+        d1_Bragg = (diff_order * (1239.852 / (photon_energy * 1000000))
+                    * constants.d1)
+        denominator = (d1_Bragg
+                       - ((cos_grating_inc_angle**2)
+                          / constants.virt_source_dist)
+                       + (cos_grating_inc_angle / constants.rad_curv)
+                       + (cos_Beta / constants.rad_curv))
+        R_Prime = cos_Beta**2 / denominator
+
+        # calc_lambda
+        Lambda = (1239.842 / (photon_energy * 1000000)) * (10**-3)
+
+        b = groove_density * diff_order * R_Prime
+        c = photon_energy / (Lambda * (10**9))
+        linear_disp = (cos_Beta / b) * c * 1000000
+    return np.where(valid, linear_disp, np.nan)
+
+
+class DispersionGeometry:
+    '''
+    Linear dispersion of the mono for one grating, with the terms that only
+    depend on the grating constants worked out once.
+
+    Substituting R' = cos(beta)^2/D into get_lin_disp, with
+    D = d1_Bragg - cos(alpha)^2/r + (cos(alpha) + cos(beta))/R, reduces it to
+    D*E^2*1e6/(N*m*cos(beta)*1239.842). sin(beta) comes straight from the
+    grating equation and cos(beta) from it, so each evaluation needs one
+    square root. For a plane grating the 1/R terms are below rounding and are
+    left out when the grating is configured.
+    '''
+
+    # Radii of curvature beyond this (mm) are treated as a plane grating
+    plane_radius = 1e12
+
+    def __init__(self, grating, diff_order=1):
+        self.grating = grating
+        self.diff_order = diff_order
+
+        inc_angle = math.radians(grating.inc_angle)
+        self.sin_inc = math.sin(inc_angle)
+        cos_inc = math.cos(inc_angle)
+        self.plane = abs(grating.rad_curv) > self.plane_radius
+        # sin(beta) = sin_inc - beta_scale/E and d1_Bragg = bragg_scale/E
+        self.beta_scale = (diff_order * 1239.852
+                           * (grating.groove_density / 1000000))
+        self.bragg_scale = diff_order * (1239.852 / 1000000) * grating.d1
+        # Energy independent part of D
+        self.focus_offset = -(cos_inc**2) / grating.virt_source_dist
+        if self.plane:
+            self.inv_rad_curv = 0.0
+        else:
+            self.inv_rad_curv = 1 / grating.rad_curv
+            self.focus_offset += cos_inc * self.inv_rad_curv
+        self.disp_scale = 1000000 / (grating.groove_density * diff_order
+                                     * 1239.842)
+
+    def lin_disp(self, photon_energy):
+        '''
+        Calculates the reciprocal linear dispersion through the exit slit
+        plane. Raises ValueError where get_lin_disp has no result (beta not
+        between 0 and 90 deg).
+        Arguments: The photon energy of the beam
+        Returns: The reciprocal linear dispersion
+        '''
+        sin_beta = self.sin_inc - self.beta_scale / photon_energy
+        if not 0 < sin_beta < 1:
+            raise ValueError(f'No diffracted beam for {photon_energy} eV.')
+        cos_beta = math.sqrt(1 - sin_beta*sin_beta)
+        denominator = self.bragg_scale / photon_energy + self.focus_offset
+        if not self.plane:
+            denominator += cos_beta * self.inv_rad_curv
+        return (denominator * photon_energy * photon_energy * self.disp_scale
+                / cos_beta)
+
+    def lin_disp_array(self, photon_energy, inc_angle=None, diff_order=None):
+        '''
+        Calculates the reciprocal linear dispersion for an array of photon
+        energies.
+        Arguments: The photon energies of the beam, optional incidence angles
+                   (rad) to use instead of the fixed one of the grating,
+                   optional diffraction orders to use instead of the
+                   configured one
+        Returns: The reciprocal linear dispersion, NaN where there is no result
+        '''
+        photon_energy = np.asarray(photon_energy, dtype=float)
+        if inc_angle is None:
+            sin_inc = self.sin_inc
+            focus_offset = self.focus_offset
+        else:
+            sin_inc = np.sin(inc_angle)
+            cos_inc = np.cos(inc_angle)
+            focus_offset = (-(cos_inc**2) / self.grating.virt_source_dist
+                            + cos_inc * self.inv_rad_curv)
+        # All order dependence is through these three scales
+        beta_scale = self.beta_scale
+        bragg_scale = self.bragg_scale
+        disp_scale = self.disp_scale
+        if diff_order is not None:
+            order_scale = np.asarray(diff_order, dtype=float) / self.diff_order
+            beta_scale = beta_scale * order_scale
+            bragg_scale = bragg_scale * order_scale
+            disp_scale = disp_scale / order_scale
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sin_beta = sin_inc - beta_scale / photon_energy
+            valid = (sin_beta > 0) & (sin_beta < 1)
+            cos_beta = np.sqrt(1 - sin_beta*sin_beta)
+            denominator = bragg_scale / photon_energy + focus_offset
+            if not self.plane:
+                denominator = denominator + cos_beta * self.inv_rad_curv
+            linear_disp = (denominator * photon_energy * photon_energy
+                           * disp_scale / cos_beta)
+        return np.where(valid, linear_disp, np.nan)
+
+
+@functools.lru_cache(maxsize=None)
+def get_dispersion_geometry(grating):
+    '''
+    Dispersion model of the mono with the named grating, built once per
+    grating.
+    Arguments: Grating name from the grating table
+    Returns: DispersionGeometry
+    '''
+    return DispersionGeometry(gratings[grating])
+
+
+class DispersionTable:
+    '''
+    Linear dispersion interpolated on a uniform energy grid.
+
+    Linear interpolation of a smooth function is least accurate near the
+    middle of each grid cell, so the grid is checked against the exact
+    formula at every cell midpoint and refined until the difference is at
+    most ``tolerance``; the achieved value is kept in ``max_error``. Energies
+    outside the grid are evaluated exactly.
+    '''
+
+    def __init__(self, dispersion, lower=250.0, upper=1600.0,
+                 tolerance=0.0005, max_points=2**20):
+        self.dispersion = dispersion
+        self.tolerance = tolerance
+        points = 257
+        while True:
+            energies = np.linspace(lower, upper, points)
+            values = dispersion.lin_disp_array(energies)
+            if not np.all(np.isfinite(values)):
+                raise ValueError(f'No linear dispersion over {lower}-{upper} '
+                                 'eV for this grating.')
+            self.interpolator = UniformGridInterpolator(energies, values,
+                                                        tolerance=np.inf)
+            midpoints = (energies[:-1] + energies[1:]) / 2
+            error = (self.interpolator.evaluate(midpoints)
+                     - dispersion.lin_disp_array(midpoints))
+            self.max_error = float(np.max(np.abs(error)))
+            if self.max_error <= tolerance:
+                break
+            if 2 * points > max_points:
+                raise ValueError(f'Linear dispersion table misses '
+                                 f'{tolerance} with {points} points.')
+            points = 2 * points - 1
+        self.points = points
+
+    def __call__(self, photon_energy):
+        '''
+        Looks up the reciprocal linear dispersion.
+        Arguments: The photon energy of the beam
+        Returns: The reciprocal linear dispersion
+        '''
+        value = self.interpolator(photon_energy)
+        if value != value:
+            return self.dispersion.lin_disp(photon_energy)
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def get_dispersion_table(grating, tolerance=0.0005):
+    '''
+    Linear dispersion table of the mono with the named grating, built once
+    per grating.
+    Arguments: Grating name from the grating table, largest allowed
+               interpolation error
+    Returns: DispersionTable
+    '''
+    return DispersionTable(get_dispersion_geometry(grating),
+                           tolerance=tolerance)
+
+
+def get_dispersion_map(geometry, dispersion, energies, cffs, slit_width):
+    '''
+    Calculates the linear dispersion and resolving power over a grid of
+    photon energy and Cff.
+    The incidence angle at each point follows from the mono pitches for that
+    energy and Cff rather than the fixed angle used for LIN_DISP. Points where
+    the grating does not focus onto the exit slit side (R' <= 0) are NaN.
+    Arguments: MonoGeometry, DispersionGeometry, energies (eV), Cff values,
+               exit slit width (um)
+    Returns: Reciprocal linear dispersion and resolving power, both shaped
+             (len(cffs), len(energies))
+    '''
+    energy, cff = np.meshgrid(np.asarray(energies, dtype=float),
+                              np.asarray(cffs, dtype=float))
+    alpha, _ = geometry.angles(*geometry.pitches(energy, cff))
+    linear_disp = dispersion.lin_disp_array(energy, alpha)
+    linear_disp[~(linear_disp > 0)] = np.nan
+    # meV/um over the slit width gives the bandwidth in meV
+    with np.errstate(divide='ignore', invalid='ignore'):
+        resolving_power = energy / (linear_disp * slit_width * 1e-3)
+    return linear_disp, resolving_power
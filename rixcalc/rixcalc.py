@@ -1,10 +1,80 @@
+import os
+import threading
+import time
 from typing import Optional
 
+import numpy as np
 from ophyd import EpicsSignalRO
-from .chemrixs import get_KBs, get_E, get_benders
-from .mono_calc import get_lin_disp
+from .chemrixs import (EnergyBranch, FocusOutput, calc_focus,
+                       get_mr1k1_setpoints, get_mr3k2_setpoints,
+                       get_mr4k2_setpoints, calibration_dirs,
+                       calibration_files, get_mono_geometry, max_scan_points,
+                       mr3k2_distance, mr4k2_distance, plan_energy_scan)
+from .gratings import default_grating, gratings
+from .mono_calc import (get_dispersion_geometry, get_dispersion_map,
+                        get_dispersion_table)
+from .dependencies import DependencyGraph
+from .calibration import (BenderCalibration, CalibrationRegistry, RangeStatus,
+                          calibration_cache, find_calibrations)
+from .watcher import CalibrationWatcher
+from caproto import AlarmSeverity, AlarmStatus, ChannelType
 from caproto.server import PVGroup, ioc_arg_parser, pvproperty, run
 
+import logging
+logger = logging.getLogger(__name__)
+
+# Alarm reported on a focus PV for each calibration range status
+RANGE_ALARMS = {
+    RangeStatus.BELOW_RANGE: (AlarmStatus.LOLO, AlarmSeverity.INVALID_ALARM),
+    RangeStatus.ABOVE_RANGE: (AlarmStatus.HIHI, AlarmSeverity.INVALID_ALARM),
+}
+
+# Set to 1 to derive LIN_DISP from the energy computed here instead of
+# SP1K1:MONO:CALC:ENERGY
+LOCAL_DISPERSION = os.environ.get('RIXCALC_LOCAL_DISPERSION', '0') == '1'
+
+# What each calculated output is computed from: PvSubscribeHelper attributes,
+# other outputs, and the calibrations and settings changed through PVs
+OUTPUT_INPUTS = {
+    'MR1K1_FOCUS': ('mr1k1_bend_us_pos', 'mr1k1_bend_ds_pos', 'MR1K1_CAL'),
+    'MR3K2_FOCUS': ('mr3k2_kbh_ds_pos', 'MR3K2_CAL'),
+    'MR4K2_FOCUS': ('mr4k2_kbh_ds_pos', 'MR4K2_CAL'),
+    'MONO_E': ('mono_gpi_rbv', 'mono_mpi_rbv', 'GRATING'),
+    'TAR_MONO_E': ('mono_gpi_sp', 'mono_mpi_sp', 'GRATING'),
+    'LIN_DISP': ('mono_e', 'GRATING', 'LIN_DISP_MODE'),
+}
+
+# LIN_DISP inputs when it follows the locally computed energy
+LOCAL_LIN_DISP_INPUTS = ('MONO_E', 'GRATING', 'LIN_DISP_MODE')
+
+# Calculated PVs posted through monitor (MDEL) and archive (ADEL) deadbands
+DEADBAND_OUTPUTS = ('mr1k1_focus', 'mr3k2_focus', 'mr4k2_focus', 'mono_e',
+                    'cff', 'tar_mono_energy', 'tar_cff', 'lin_disp')
+
+# Most diffraction orders DIFF_ORDERS accepts
+max_diffraction_orders = 8
+
+# Size of the energy x Cff dispersion map
+map_energy_points = 136
+map_cff_points = 51
+
+# Calibration interpolation method for each FOCUS_INTERP choice
+INTERPOLATION_METHODS = {
+    'Linear': 'linear',
+    'PCHIP': 'pchip',
+}
+
+
+def _outside_deadband(value, last, deadband):
+    '''
+    Whether value has to be posted given the last posted value and a deadband.
+    '''
+    if last is None or deadband < 0:
+        return True
+    # NaN differences count as a change
+    return not abs(value - last) <= deadband
+
+
 class PvSubscribeHelper:
     # These are type hints that tell our IDE that this class has a "mr1k1_bend_us_pos"
     # attribute that should be a float but sometimes might be uninitialized -
@@ -26,7 +96,7 @@ class PvSubscribeHelper:
     # onto an attribute.
     signals: dict[EpicsSignalRO, str]
 
-    def __init__(self):
+    def __init__(self, subscribe_mono_energy=True):
         # On initialization, we don't have values just yet!
         self.mr1k1_bend_us_pos = None
         self.mr1k1_bend_ds_pos = None
@@ -40,6 +110,9 @@ class PvSubscribeHelper:
         self.mono_mpi_sp = None
         self.mono_e = None
 
+        self.subscribe_mono_energy = subscribe_mono_energy
+        # Called with the attribute name after every update, from the CA thread
+        self.listener = None
         self.subscribe()
 
     def subscribe(self):
@@ -54,8 +127,9 @@ class PvSubscribeHelper:
             EpicsSignalRO("SP1K1:MONO:MMS:G_PI"): "mono_gpi_sp",
             EpicsSignalRO("SP1K1:MONO:MMS:M_PI.RBV"): "mono_mpi_rbv",
             EpicsSignalRO("SP1K1:MONO:MMS:M_PI"): "mono_mpi_sp",
-            EpicsSignalRO("SP1K1:MONO:CALC:ENERGY"): "mono_e",
         }
+        if self.subscribe_mono_energy:
+            self.signals[EpicsSignalRO("SP1K1:MONO:CALC:ENERGY")] = "mono_e"
 
         for sig in self.signals:
             sig.subscribe(self.value_update_callback)
@@ -63,6 +137,8 @@ class PvSubscribeHelper:
     def value_update_callback(self, value, obj: EpicsSignalRO, **kwargs):
         attribute_name = self.signals[obj]
         setattr(self, attribute_name, value)
+        if self.listener is not None:
+            self.listener(attribute_name)
 
 
 
@@ -73,6 +149,15 @@ class Rixcalc(PVGroup):
     General Purpose IOC for using python to calculate and build various PVs.
     """
 
+    grating = pvproperty(
+        value=default_grating,
+        name='GRATING',
+        dtype=ChannelType.ENUM,
+        enum_strings=tuple(gratings),
+        record='mbbo',
+        doc='Grating used by the mono energy and dispersion calculations',
+    )
+
     tar_mono_energy = pvproperty(
         value=0.0,
         name='TAR_MONO_E',
@@ -93,6 +178,217 @@ class Rixcalc(PVGroup):
         precision=3,
     )
 
+    cff = pvproperty(
+        value=0.0,
+        name='CFF',
+        record='ai',
+        read_only=True,
+        doc='Current Mono Cff',
+        precision=3,
+    )
+
+    tar_cff = pvproperty(
+        value=0.0,
+        name='TAR_CFF',
+        record='ai',
+        read_only=True,
+        doc='Current Target Mono Cff',
+        precision=3,
+    )
+
+    req_mono_energy = pvproperty(
+        value=0.0,
+        name='REQ_MONO_E',
+        record='ao',
+        units='eV',
+        doc='Requested Mono Energy for the pitch setpoint calculation',
+        precision=3,
+    )
+
+    req_cff = pvproperty(
+        value=0.0,
+        name='REQ_CFF',
+        record='ao',
+        doc='Requested Mono Cff for the pitch setpoint calculation',
+        precision=3,
+    )
+
+    req_gpi = pvproperty(
+        value=0.0,
+        name='REQ_G_PI',
+        record='ai',
+        read_only=True,
+        units='urad',
+        doc='Grating pitch setpoint for the requested energy and Cff',
+        precision=3,
+        alarm_group='req_pitch',
+    )
+
+    req_mpi = pvproperty(
+        value=0.0,
+        name='REQ_M_PI',
+        record='ai',
+        read_only=True,
+        units='urad',
+        doc='Pre-mirror pitch setpoint for the requested energy and Cff',
+        precision=3,
+        alarm_group='req_pitch',
+    )
+
+    scan_start = pvproperty(
+        value=0.0,
+        name='SCAN_START',
+        record='ao',
+        units='eV',
+        doc='Energy scan start',
+        precision=3,
+    )
+
+    scan_stop = pvproperty(
+        value=0.0,
+        name='SCAN_STOP',
+        record='ao',
+        units='eV',
+        doc='Energy scan stop',
+        precision=3,
+    )
+
+    scan_step = pvproperty(
+        value=0.0,
+        name='SCAN_STEP',
+        record='ao',
+        units='eV',
+        doc='Energy scan step',
+        precision=3,
+    )
+
+    scan_cff = pvproperty(
+        value=2.0,
+        name='SCAN_CFF',
+        record='ao',
+        doc='Energy scan Cff',
+        precision=3,
+    )
+
+    scan_npts = pvproperty(
+        value=0,
+        name='SCAN_NPTS',
+        record='longin',
+        read_only=True,
+        doc='Number of points in the energy scan trajectory',
+        alarm_group='scan_plan',
+    )
+
+    scan_energies = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=max_scan_points,
+        name='SCAN_ENERGIES',
+        read_only=True,
+        doc='Energy scan trajectory: photon energies (eV)',
+        alarm_group='scan_plan',
+    )
+
+    scan_gpi = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=max_scan_points,
+        name='SCAN_G_PI',
+        read_only=True,
+        doc='Energy scan trajectory: grating pitch (urad)',
+        alarm_group='scan_plan',
+    )
+
+    scan_mpi = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=max_scan_points,
+        name='SCAN_M_PI',
+        read_only=True,
+        doc='Energy scan trajectory: pre-mirror pitch (urad)',
+        alarm_group='scan_plan',
+    )
+
+    map_e_min = pvproperty(
+        value=250.0,
+        name='MAP_E_MIN',
+        record='ao',
+        units='eV',
+        doc='Dispersion map lowest energy',
+        precision=3,
+    )
+
+    map_e_max = pvproperty(
+        value=1600.0,
+        name='MAP_E_MAX',
+        record='ao',
+        units='eV',
+        doc='Dispersion map highest energy',
+        precision=3,
+    )
+
+    map_cff_min = pvproperty(
+        value=1.05,
+        name='MAP_CFF_MIN',
+        record='ao',
+        doc='Dispersion map lowest Cff',
+        precision=3,
+    )
+
+    map_cff_max = pvproperty(
+        value=2.5,
+        name='MAP_CFF_MAX',
+        record='ao',
+        doc='Dispersion map highest Cff',
+        precision=3,
+    )
+
+    map_slit_width = pvproperty(
+        value=10.0,
+        name='MAP_SLIT_WIDTH',
+        record='ao',
+        units='um',
+        doc='Exit slit width used for the resolving power map',
+        precision=3,
+    )
+
+    map_energies = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=map_energy_points,
+        name='MAP_ENERGIES',
+        read_only=True,
+        doc='Dispersion map energy axis (eV)',
+    )
+
+    map_cffs = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=map_cff_points,
+        name='MAP_CFFS',
+        read_only=True,
+        doc='Dispersion map Cff axis',
+    )
+
+    map_lin_disp = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=map_energy_points*map_cff_points,
+        name='MAP_LIN_DISP',
+        read_only=True,
+        doc=('Reciprocal linear dispersion (meV/um) over Cff x energy, one '
+             'row per Cff'),
+    )
+
+    map_res_power = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=map_energy_points*map_cff_points,
+        name='MAP_RES_POWER',
+        read_only=True,
+        doc='Resolving power over Cff x energy, one row per Cff',
+    )
+
     mr1k1_focus = pvproperty(
         value=0.0,
         name='MR1K1_FOCUS',
@@ -101,6 +397,7 @@ class Rixcalc(PVGroup):
         units='m',
         doc='MR1K1 Focus',
         precision=3,
+        alarm_group='mr1k1_focus',
     )
 
     mr3k2_focus = pvproperty(
@@ -111,6 +408,7 @@ class Rixcalc(PVGroup):
         units='m',
         doc='MR3K2 (Horizontal) Focus',
         precision=3,
+        alarm_group='mr3k2_focus',
     )
 
     mr4k2_focus = pvproperty(
@@ -121,6 +419,121 @@ class Rixcalc(PVGroup):
         units='m',
         doc='MR4K2 (Vertical) Focus',
         precision=3,
+        alarm_group='mr4k2_focus',
+    )
+
+    mr3k2_focus_us = pvproperty(
+        value=0.0,
+        name='MR3K2_FOCUS_US',
+        record='ai',
+        read_only=True,
+        units='m',
+        doc=('MR3K2 (Horizontal) Focus from the upstream bender, computed '
+             'on read'),
+        precision=3,
+        alarm_group='mr3k2_focus_us',
+    )
+
+    mr4k2_focus_us = pvproperty(
+        value=0.0,
+        name='MR4K2_FOCUS_US',
+        record='ai',
+        read_only=True,
+        units='m',
+        doc=('MR4K2 (Vertical) Focus from the upstream bender, computed on '
+             'read'),
+        precision=3,
+        alarm_group='mr4k2_focus_us',
+    )
+
+    focus_interp = pvproperty(
+        value='Linear',
+        name='FOCUS_INTERP',
+        dtype=ChannelType.ENUM,
+        enum_strings=tuple(INTERPOLATION_METHODS),
+        record='mbbo',
+        doc='Interpolation used on the bender calibration tables',
+    )
+
+    mr1k1_tar_focus = pvproperty(
+        value=0.0,
+        name='MR1K1_TAR_FOCUS',
+        record='ao',
+        units='m',
+        doc='MR1K1 Target Focus',
+        precision=3,
+    )
+
+    mr1k1_bend_us_sp = pvproperty(
+        value=0.0,
+        name='MR1K1_BEND_US_SP',
+        record='ai',
+        read_only=True,
+        doc='MR1K1 Upstream Bender Setpoint for Target Focus',
+        precision=3,
+    )
+
+    mr1k1_bend_ds_sp = pvproperty(
+        value=0.0,
+        name='MR1K1_BEND_DS_SP',
+        record='ai',
+        read_only=True,
+        doc='MR1K1 Downstream Bender Setpoint for Target Focus',
+        precision=3,
+    )
+
+    mr3k2_tar_focus = pvproperty(
+        value=0.0,
+        name='MR3K2_TAR_FOCUS',
+        record='ao',
+        units='m',
+        doc='MR3K2 (Horizontal) Target Focus',
+        precision=3,
+    )
+
+    mr3k2_bend_us_sp = pvproperty(
+        value=0.0,
+        name='MR3K2_BEND_US_SP',
+        record='ai',
+        read_only=True,
+        doc='MR3K2 Upstream Bender Setpoint for Target Focus',
+        precision=3,
+    )
+
+    mr3k2_bend_ds_sp = pvproperty(
+        value=0.0,
+        name='MR3K2_BEND_DS_SP',
+        record='ai',
+        read_only=True,
+        doc='MR3K2 Downstream Bender Setpoint for Target Focus',
+        precision=3,
+    )
+
+    mr4k2_tar_focus = pvproperty(
+        value=0.0,
+        name='MR4K2_TAR_FOCUS',
+        record='ao',
+        units='m',
+        doc='MR4K2 (Vertical) Target Focus',
+        precision=3,
+    )
+
+    mr4k2_bend_us_sp = pvproperty(
+        value=0.0,
+        name='MR4K2_BEND_US_SP',
+        record='ai',
+        read_only=True,
+        doc='MR4K2 Upstream Bender Setpoint for Target Focus',
+        precision=3,
+    )
+
+    mr4k2_bend_ds_sp = pvproperty(
+        value=0.0,
+        name='MR4K2_BEND_DS_SP',
+        record='ai',
+        read_only=True,
+        doc='MR4K2 Downstream Bender Setpoint for Target Focus',
+        precision=3,
     )
 
     lin_disp = pvproperty(
@@ -133,6 +546,157 @@ class Rixcalc(PVGroup):
         precision=3,
     )
 
+    diff_orders = pvproperty(
+        value=[1, 2, 3],
+        dtype=int,
+        max_length=max_diffraction_orders,
+        name='DIFF_ORDERS',
+        doc='Diffraction orders evaluated for ORDER_MONO_E and ORDER_LIN_DISP',
+    )
+
+    order_mono_e = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=max_diffraction_orders,
+        name='ORDER_MONO_E',
+        read_only=True,
+        doc=('Photon energy (eV) passed in each of DIFF_ORDERS at the '
+             'current pitches'),
+    )
+
+    order_lin_disp = pvproperty(
+        value=[],
+        dtype=float,
+        max_length=max_diffraction_orders,
+        name='ORDER_LIN_DISP',
+        read_only=True,
+        doc=('Reciprocal linear dispersion (meV/um) of each of DIFF_ORDERS '
+             'at the current pitches'),
+    )
+
+    mono_e_skips = pvproperty(
+        value=0,
+        name='MONO_E_SKIPS',
+        record='longin',
+        read_only=True,
+        doc=('Mono energy evaluations skipped because the pitch RBVs did '
+             'not change'),
+    )
+
+    tar_mono_e_skips = pvproperty(
+        value=0,
+        name='TAR_MONO_E_SKIPS',
+        record='longin',
+        read_only=True,
+        doc=('Target mono energy evaluations skipped because the pitch '
+             'setpoints did not change'),
+    )
+
+    lin_disp_mode = pvproperty(
+        value='Exact',
+        name='LIN_DISP_MODE',
+        dtype=ChannelType.ENUM,
+        enum_strings=('Exact', 'Table'),
+        record='mbbo',
+        doc=('Evaluate the linear dispersion exactly or from a precomputed '
+             'energy grid'),
+    )
+
+    lin_disp_table_err = pvproperty(
+        value=0.0,
+        name='LIN_DISP_TABLE_ERR',
+        record='ai',
+        read_only=True,
+        units='meV/um',
+        doc='Largest interpolation error of the linear dispersion table',
+        precision=6,
+    )
+
+    cal_cache_hits = pvproperty(
+        value=0,
+        name='CAL_CACHE_HITS',
+        record='longin',
+        read_only=True,
+        doc='Calibration table lookups served from memory',
+    )
+
+    cal_cache_misses = pvproperty(
+        value=0,
+        name='CAL_CACHE_MISSES',
+        record='longin',
+        read_only=True,
+        doc='Calibration table lookups that parsed the file',
+    )
+
+    mr1k1_cal_id = pvproperty(
+        value='default',
+        name='MR1K1_CAL_ID',
+        record='stringout',
+        doc='Active MR1K1 calibration',
+    )
+
+    mr3k2_cal_id = pvproperty(
+        value='default',
+        name='MR3K2_CAL_ID',
+        record='stringout',
+        doc='Active MR3K2 calibration',
+    )
+
+    mr4k2_cal_id = pvproperty(
+        value='default',
+        name='MR4K2_CAL_ID',
+        record='stringout',
+        doc='Active MR4K2 calibration',
+    )
+
+    mr1k1_cal_hash = pvproperty(
+        value='',
+        name='MR1K1_CAL_HASH',
+        record='stringin',
+        read_only=True,
+        doc='SHA-256 prefix of the loaded MR1K1 calibration table',
+    )
+
+    mr1k1_cal_time = pvproperty(
+        value='',
+        name='MR1K1_CAL_TIME',
+        record='stringin',
+        read_only=True,
+        doc='Time the MR1K1 calibration table was loaded',
+    )
+
+    mr3k2_cal_hash = pvproperty(
+        value='',
+        name='MR3K2_CAL_HASH',
+        record='stringin',
+        read_only=True,
+        doc='SHA-256 prefix of the loaded MR3K2 calibration table',
+    )
+
+    mr3k2_cal_time = pvproperty(
+        value='',
+        name='MR3K2_CAL_TIME',
+        record='stringin',
+        read_only=True,
+        doc='Time the MR3K2 calibration table was loaded',
+    )
+
+    mr4k2_cal_hash = pvproperty(
+        value='',
+        name='MR4K2_CAL_HASH',
+        record='stringin',
+        read_only=True,
+        doc='SHA-256 prefix of the loaded MR4K2 calibration table',
+    )
+
+    mr4k2_cal_time = pvproperty(
+        value='',
+        name='MR4K2_CAL_TIME',
+        record='stringin',
+        read_only=True,
+        doc='Time the MR4K2 calibration table was loaded',
+    )
+
     calc_update = pvproperty(
         value=True,
         record="bo",
@@ -140,28 +704,602 @@ class Rixcalc(PVGroup):
         doc="Calculation helper - periodically update calculation data"
     )
 
+    calc_mode = pvproperty(
+        value='Poll',
+        name='CALC_MODE',
+        dtype=ChannelType.ENUM,
+        enum_strings=('Poll', 'Event'),
+        record='mbbo',
+        doc=('Recompute on the 1 Hz scan only, or also as soon as an input '
+             'changes'),
+    )
+
+    calc_debounce = pvproperty(
+        value=0.05,
+        name='CALC_DEBOUNCE',
+        record='ao',
+        units='s',
+        doc='Shortest interval between two event-driven recomputations',
+        precision=3,
+    )
 
-    def __init__(self, *args, **kwargs):
+    calc_recomputes = pvproperty(
+        value=0,
+        name='CALC_RECOMPUTES',
+        record='longin',
+        read_only=True,
+        doc='Outputs recomputed in the last calculation cycle',
+    )
+
+    calc_recompute_total = pvproperty(
+        value=0,
+        name='CALC_RECOMPUTE_TOTAL',
+        record='longin',
+        read_only=True,
+        doc='Outputs recomputed since the IOC started',
+    )
+
+    def __init__(self, *args, local_dispersion=LOCAL_DISPERSION,
+                 **kwargs):
         super().__init__(*args, **kwargs)
         # Init here
 
-        self.pv_subscribe_helper = PvSubscribeHelper()
+        # With local_dispersion, LIN_DISP follows the MONO_E computed here and
+        # the mono energy of the other IOC is not needed
+        self.local_dispersion = local_dispersion
+        self.pv_subscribe_helper = PvSubscribeHelper(
+            subscribe_mono_energy=not local_dispersion)
+
+        # Models of the selected grating; both are built once per grating
+        self.mono_geometry = get_mono_geometry(default_grating)
+        self.dispersion = get_dispersion_geometry(default_grating)
+        self.dispersion_table = None
+        # Built on the first read of a map PV and kept until its inputs change
+        self.dispersion_map = None
+        # The RBV and setpoint energies are only recomputed when their own
+        # pitches change
+        self.rbv_energy = EnergyBranch()
+        self.sp_energy = EnergyBranch()
+
+        # Every known calibration is preloaded; the active one per mirror is
+        # used by the calculations. The watcher loads edited tables in the
+        # background; they are swapped in at the next cycle.
+        self.interpolation = 'linear'
+        self.registry = CalibrationRegistry()
+        self.registry.load(
+            find_calibrations(calibration_dirs, calibration_files),
+            self.load_calibration)
+        self._new_calibrations = set(self.registry.active)
+        self.calibration_watcher = CalibrationWatcher(
+            self.registry.paths, loader=self.load_calibration)
+        self.calibration_watcher.start()
+
+        # Only outputs downstream of a changed input are recomputed
+        dependencies = dict(OUTPUT_INPUTS)
+        if local_dispersion:
+            dependencies['LIN_DISP'] = LOCAL_LIN_DISP_INPUTS
+        self.dependencies = DependencyGraph(dependencies)
+        self.dependencies.mark_all_dirty()
+        self.output_updaters = {
+            'MR1K1_FOCUS': self.update_mr1k1_focus,
+            'MR3K2_FOCUS': self.update_mr3k2_focus,
+            'MR4K2_FOCUS': self.update_mr4k2_focus,
+            'MONO_E': self.update_mono_energy,
+            'TAR_MONO_E': self.update_target_mono_energy,
+            'LIN_DISP': self.update_lin_disp,
+        }
+        # Last value posted per deadbanded PV
+        self._posted = {}
+        # Set up by setup_async from the first scan or startup hook to run
+        self._recompute_lock = None
+        self._wake = None
+        self._wake_requested = threading.Event()
+        self.pv_subscribe_helper.listener = self.input_changed
+
+    def load_calibration(self, path):
+        '''
+        Loads a calibration table with the selected interpolation method.
+        '''
+        if self.interpolation == 'linear':
+            return calibration_cache.get(path)
+        return BenderCalibration.from_file(path, method=self.interpolation)
+
+    @grating.putter
+    async def grating(self, instance, value):
+        self.mono_geometry = get_mono_geometry(value)
+        self.dispersion = get_dispersion_geometry(value)
+        self.dispersion_map = None
+        if self.dispersion_table is not None:
+            await self.load_dispersion_table(value)
+        self.input_changed('GRATING')
+        # Pitches depend on the grating, so refresh any request already made
+        if self.req_mono_energy.value:
+            await self.update_pitch_setpoints(self.req_mono_energy.value,
+                                              self.req_cff.value)
+        await self.update_scan_plan()
+        return value
+
+    @lin_disp_mode.putter
+    async def lin_disp_mode(self, instance, value):
+        if value == 'Table':
+            await self.load_dispersion_table(self.grating.value)
+        else:
+            self.dispersion_table = None
+        self.input_changed('LIN_DISP_MODE')
+        return value
+
+    async def load_dispersion_table(self, grating):
+        '''
+        Installs the linear dispersion table of a grating, built to stay within
+        half a unit of the last digit LIN_DISP displays.
+        '''
+        tolerance = 0.5 * 10**-self.lin_disp.precision
+        self.dispersion_table = get_dispersion_table(grating, tolerance)
+        await self.lin_disp_table_err.write(self.dispersion_table.max_error)
+
+    @diff_orders.putter
+    async def diff_orders(self, instance, value):
+        if any(order < 1 for order in value):
+            raise ValueError('Diffraction orders must be positive.')
+        await self.update_orders(value)
+        return value
+
+    async def update_orders(self, orders):
+        '''
+        Publishes the photon energy and dispersion of every diffraction
+        order at the current pitch RBVs, evaluated together.
+        '''
+        helper = self.pv_subscribe_helper
+        if helper.mono_gpi_rbv is None or helper.mono_mpi_rbv is None:
+            return
+        energies = self.mono_geometry.energy_orders(
+            helper.mono_gpi_rbv, helper.mono_mpi_rbv, orders)
+        lin_disp = self.dispersion.lin_disp_array(energies, diff_order=orders)
+        await self.order_mono_e.write(energies.tolist())
+        await self.order_lin_disp.write(lin_disp.tolist())
+
+    @map_e_min.putter
+    async def map_e_min(self, instance, value):
+        self.dispersion_map = None
+        return value
+
+    @map_e_max.putter
+    async def map_e_max(self, instance, value):
+        self.dispersion_map = None
+        return value
+
+    @map_cff_min.putter
+    async def map_cff_min(self, instance, value):
+        self.dispersion_map = None
+        return value
+
+    @map_cff_max.putter
+    async def map_cff_max(self, instance, value):
+        self.dispersion_map = None
+        return value
+
+    @map_slit_width.putter
+    async def map_slit_width(self, instance, value):
+        self.dispersion_map = None
+        return value
+
+    @map_energies.getter
+    async def map_energies(self, instance):
+        return self.read_dispersion_map()['energies']
+
+    @map_cffs.getter
+    async def map_cffs(self, instance):
+        return self.read_dispersion_map()['cffs']
+
+    @map_lin_disp.getter
+    async def map_lin_disp(self, instance):
+        return self.read_dispersion_map()['lin_disp']
+
+    @map_res_power.getter
+    async def map_res_power(self, instance):
+        return self.read_dispersion_map()['res_power']
+
+    def read_dispersion_map(self):
+        '''
+        Returns the energy x Cff dispersion map, building it if its inputs
+        changed since the last read.
+        '''
+        if self.dispersion_map is None:
+            energies = np.linspace(self.map_e_min.value, self.map_e_max.value,
+                                   map_energy_points)
+            cffs = np.linspace(self.map_cff_min.value, self.map_cff_max.value,
+                               map_cff_points)
+            lin_disp, res_power = get_dispersion_map(
+                self.mono_geometry, self.dispersion, energies, cffs,
+                self.map_slit_width.value)
+            self.dispersion_map = {
+                'energies': energies.tolist(),
+                'cffs': cffs.tolist(),
+                'lin_disp': lin_disp.ravel().tolist(),
+                'res_power': res_power.ravel().tolist(),
+            }
+        return self.dispersion_map
+
+    @focus_interp.putter
+    async def focus_interp(self, instance, value):
+        self.interpolation = INTERPOLATION_METHODS[value]
+        # Rebuilt off the event loop and swapped in together at a later cycle
+        self.calibration_watcher.reload()
+        return value
+
+    @mr1k1_cal_id.putter
+    async def mr1k1_cal_id(self, instance, value):
+        self.registry.select('MR1K1', value)
+        self._new_calibrations.add('MR1K1')
+        return value
+
+    @mr3k2_cal_id.putter
+    async def mr3k2_cal_id(self, instance, value):
+        self.registry.select('MR3K2', value)
+        self._new_calibrations.add('MR3K2')
+        return value
+
+    @mr4k2_cal_id.putter
+    async def mr4k2_cal_id(self, instance, value):
+        self.registry.select('MR4K2', value)
+        self._new_calibrations.add('MR4K2')
+        return value
+
+    @mr3k2_focus_us.getter
+    async def mr3k2_focus_us(self, instance):
+        return await self.read_upstream_focus(
+            instance, 'MR3K2', self.pv_subscribe_helper.mr3k2_kbh_us_pos,
+            mr3k2_distance)
+
+    @mr4k2_focus_us.getter
+    async def mr4k2_focus_us(self, instance):
+        return await self.read_upstream_focus(
+            instance, 'MR4K2', self.pv_subscribe_helper.mr4k2_kbh_us_pos,
+            mr4k2_distance)
+
+    async def read_upstream_focus(self, instance, name, us, distance):
+        '''
+        Computes an upstream focus PV on demand instead of in every scan.
+        Returning None keeps the previous value without writing it back,
+        which would clear the alarm.
+        '''
+        if us is None:
+            return None
+        value, status = calc_focus(self.registry.active[name], us, None,
+                                   FocusOutput.UPSTREAM, distance)
+        if status:
+            alarm_status, severity = RANGE_ALARMS[status]
+            await instance.alarm.write(status=alarm_status, severity=severity)
+            return None
+        return value
+
+    @req_mono_energy.putter
+    async def req_mono_energy(self, instance, value):
+        await self.update_pitch_setpoints(value, self.req_cff.value)
+        return value
+
+    @req_cff.putter
+    async def req_cff(self, instance, value):
+        await self.update_pitch_setpoints(self.req_mono_energy.value, value)
+        return value
+
+    async def update_pitch_setpoints(self, energy, cff):
+        '''
+        Publishes the mono pitches for a requested energy and Cff, or flags
+        them invalid when the request has no solution (e.g. Cff not above 1).
+        '''
+        pitchG, pitchM2 = self.mono_geometry.pitches(energy, cff)
+        if not np.isfinite(pitchG) or not np.isfinite(pitchM2):
+            await self.req_gpi.alarm.write(
+                status=AlarmStatus.CALC,
+                severity=AlarmSeverity.INVALID_ALARM)
+            return
+        await self.req_gpi.write(float(pitchG))
+        await self.req_mpi.write(float(pitchM2))
+
+    @scan_start.putter
+    async def scan_start(self, instance, value):
+        await self.update_scan_plan(start=value)
+        return value
+
+    @scan_stop.putter
+    async def scan_stop(self, instance, value):
+        await self.update_scan_plan(stop=value)
+        return value
+
+    @scan_step.putter
+    async def scan_step(self, instance, value):
+        await self.update_scan_plan(step=value)
+        return value
+
+    @scan_cff.putter
+    async def scan_cff(self, instance, value):
+        await self.update_scan_plan(cff=value)
+        return value
+
+    async def update_scan_plan(self, **changed):
+        '''
+        Recomputes the energy scan trajectory waveforms after a scan
+        parameter changed. Parameters not given are taken from their PVs.
+        Until a step is set the trajectory is empty. The parameters are only
+        checked together here, so they can be put in any order; an impossible
+        scan empties the trajectory and a scan with unreachable points leaves
+        them NaN, both in alarm.
+        '''
+        params = dict(start=self.scan_start.value, stop=self.scan_stop.value,
+                      step=self.scan_step.value, cff=self.scan_cff.value)
+        params.update(changed)
+        energies = pitchG = pitchM2 = np.zeros(0)
+        valid = True
+        if params['step'] != 0:
+            try:
+                energies, pitchG, pitchM2 = plan_energy_scan(
+                    **params, geometry=self.mono_geometry)
+            except ValueError as ex:
+                logger.warning('Invalid energy scan: %s', ex)
+                valid = False
+            else:
+                valid = bool(np.isfinite(pitchG).all()
+                             and np.isfinite(pitchM2).all())
+        await self.scan_energies.write(energies.tolist())
+        await self.scan_gpi.write(pitchG.tolist())
+        await self.scan_mpi.write(pitchM2.tolist())
+        await self.scan_npts.write(len(energies))
+        if not valid:
+            # Shared by the trajectory PVs through their alarm group
+            await self.scan_npts.alarm.write(
+                status=AlarmStatus.CALC,
+                severity=AlarmSeverity.INVALID_ALARM)
+
+    async def write_focus(self, pv, value, status):
+        '''
+        Publishes a focus value, or flags the PV with an alarm when the
+        benders are outside the calibration table and keeps the last good
+        value.
+        '''
+        if status:
+            alarm_status, severity = RANGE_ALARMS[status]
+            await pv.alarm.write(status=alarm_status, severity=severity)
+        else:
+            await self.write_output(pv, value)
+
+    async def init_deadbands(self):
+        '''
+        Defaults the MDEL and ADEL fields of the calculated PVs to one unit of
+        their last displayed digit. Both can be changed through the fields.
+        '''
+        for name in DEADBAND_OUTPUTS:
+            pv = getattr(self, name)
+            deadband = 10**-pv.precision
+            await pv.fields['MDEL'].write(deadband)
+            await pv.fields['ADEL'].write(deadband)
+
+    async def write_output(self, pv, value):
+        '''
+        Writes a calculated value only if it moved past the deadband since it
+        was last posted, as an EPICS record would. A negative deadband posts
+        every value. Alarmed PVs are always written so that the alarm clears.
+        '''
+        # caproto sends every write to all subscribers whatever event mask they
+        # asked for, so the monitor (MDEL) and archive (ADEL) deadbands cannot
+        # be applied separately; the smaller of the two is used for both.
+        deadband = min(pv.value_atol, pv.log_atol)
+        last = self._posted.get(pv.pvname)
+        if (pv.alarm.severity == AlarmSeverity.NO_ALARM
+                and not _outside_deadband(value, last, deadband)):
+            return
+        self._posted[pv.pvname] = value
+        await pv.write(value)
+
+    async def swap_calibrations(self):
+        '''
+        Installs calibrations reloaded by the watcher and publishes their
+        version.
+        '''
+        pending = self.calibration_watcher.pop_pending()
+        for (name, cal_id), calibration in pending.items():
+            self.registry.add(name, cal_id, calibration)
+            if self.registry.active_ids[name] == cal_id:
+                logger.info('Switching %s to calibration %s', name,
+                            calibration.sha256)
+                self._new_calibrations.add(name)
+
+        for name in self._new_calibrations:
+            self.dependencies.mark_dirty(f'{name}_CAL')
+            calibration = self.registry.active[name]
+            loaded_at = time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(calibration.loaded_at))
+            sha256 = calibration.sha256 or ''
+            await getattr(self, f'{name.lower()}_cal_hash').write(sha256[:16])
+            await getattr(self, f'{name.lower()}_cal_time').write(loaded_at)
+        self._new_calibrations.clear()
+
+    @mr1k1_tar_focus.putter
+    async def mr1k1_tar_focus(self, instance, value):
+        us, ds = get_mr1k1_setpoints(value, self.registry.active['MR1K1'])
+        await self.mr1k1_bend_us_sp.write(us)
+        await self.mr1k1_bend_ds_sp.write(ds)
+        return value
+
+    @mr3k2_tar_focus.putter
+    async def mr3k2_tar_focus(self, instance, value):
+        us, ds = get_mr3k2_setpoints(value, self.registry.active['MR3K2'])
+        await self.mr3k2_bend_us_sp.write(us)
+        await self.mr3k2_bend_ds_sp.write(ds)
+        return value
+
+    @mr4k2_tar_focus.putter
+    async def mr4k2_tar_focus(self, instance, value):
+        us, ds = get_mr4k2_setpoints(value, self.registry.active['MR4K2'])
+        await self.mr4k2_bend_us_sp.write(us)
+        await self.mr4k2_bend_ds_sp.write(ds)
+        return value
+
+    def setup_async(self, async_lib):
+        '''
+        Creates the recompute lock and the Event mode wake-up queue with the
+        primitives of the async library the IOC runs on. Called before the
+        first await of every hook that recomputes, so it is done before any
+        recompute whichever hook starts first.
+        '''
+        if self._recompute_lock is None:
+            self._recompute_lock = async_lib.library.Lock()
+            self._wake = async_lib.ThreadsafeQueue()
+
+    @mr1k1_focus.startup
+    async def mr1k1_focus(self, instance, async_lib):
+        '''
+        Sets up the deadbands of all calculated outputs.
+        '''
+        await self.init_deadbands()
 
     @calc_update.scan(period=1.0, use_scan_field=True)
     async def calc_update(self, instance, async_lib):
+        self.setup_async(async_lib)
+        await self.swap_calibrations()
+        await self.recompute()
+        if calibration_cache.hits != self.cal_cache_hits.value:
+            await self.cal_cache_hits.write(calibration_cache.hits)
+        if calibration_cache.misses != self.cal_cache_misses.value:
+            await self.cal_cache_misses.write(calibration_cache.misses)
+
+    @calc_mode.startup
+    async def calc_mode(self, instance, async_lib):
+        '''
+        Recomputes the outputs fed by changed inputs while in Event mode.
+        Changes within CALC_DEBOUNCE of the last recompute are merged.
+        '''
+        self.setup_async(async_lib)
+        last = 0.0
+        while True:
+            await self._wake.async_get()
+            delay = last + self.calc_debounce.value - time.monotonic()
+            if delay > 0:
+                await async_lib.sleep(delay)
+            # Changes from here on need another recompute
+            self._wake_requested.clear()
+            last = time.monotonic()
+            await self.recompute()
+
+    def input_changed(self, name):
+        '''
+        Marks an input as changed, and in Event mode wakes the recompute task.
+        Called by PvSubscribeHelper from the CA thread as well as from putters.
+        '''
+        self.dependencies.mark_dirty(name)
+        if (self._wake is not None and self.calc_mode.value == 'Event'
+                and not self._wake_requested.is_set()):
+            self._wake_requested.set()
+            self._wake.put(name)
+
+    async def recompute(self):
+        '''
+        Recomputes the outputs affected by the inputs changed since the last
+        cycle. The scan and Event mode never recompute at the same time.
+        The counters are only written when they change.
+        '''
+        async with self._recompute_lock:
+            recomputed = 0
+            for output in self.dependencies.pop_dirty():
+                if await self.output_updaters[output]():
+                    recomputed += 1
+            if recomputed != self.calc_recomputes.value:
+                await self.calc_recomputes.write(recomputed)
+            if recomputed:
+                await self.calc_recompute_total.write(
+                    self.calc_recompute_total.value + recomputed)
+
+    async def update_mr1k1_focus(self):
+        '''
+        Publishes the MR1K1 focus once both bender positions are known.
+        '''
         helper = self.pv_subscribe_helper
-        if all(x is not None for x in (helper.mr1k1_bend_us_pos, helper.mr1k1_bend_ds_pos, helper.mr3k2_kbh_us_pos, helper.mr3k2_kbh_ds_pos, helper.mr4k2_kbh_us_pos, helper.mr4k2_kbh_ds_pos)) :
-            mr1k1 = get_benders(helper.mr1k1_bend_us_pos, helper.mr1k1_bend_ds_pos)
-            mr3k2_h_1, mr3k2_h_2, mr4k2_v_1, mr4k2_v_2 = get_KBs(helper.mr3k2_kbh_us_pos, helper.mr3k2_kbh_ds_pos, helper.mr4k2_kbh_us_pos, helper.mr4k2_kbh_ds_pos)
- 
-            await self.mr1k1_focus.write(mr1k1)
-            await self.mr3k2_focus.write(mr3k2_h_2)
-            await self.mr4k2_focus.write(mr4k2_v_2)
-
-        if all(x is not None for x in (helper.mono_gpi_rbv, helper.mono_gpi_sp, helper.mono_mpi_rbv, helper.mono_mpi_sp, helper.mono_e)):
-            current_mono_energy, target_mono_energy = get_E(helper.mono_gpi_rbv, helper.mono_gpi_sp, helper.mono_mpi_rbv, helper.mono_mpi_sp)
-            linear_dispersion = get_lin_disp(helper.mono_e)
-
-            await self.mono_e.write(current_mono_energy)
-            await self.tar_mono_energy.write(target_mono_energy)
-            await self.lin_disp.write(linear_dispersion)
+        if (helper.mr1k1_bend_us_pos is None
+                or helper.mr1k1_bend_ds_pos is None):
+            return False
+        mr1k1, mr1k1_status = calc_focus(
+            self.registry.active['MR1K1'], helper.mr1k1_bend_us_pos,
+            helper.mr1k1_bend_ds_pos, FocusOutput.AVERAGE)
+        await self.write_focus(self.mr1k1_focus, mr1k1, mr1k1_status)
+        return True
+
+    async def update_mr3k2_focus(self):
+        '''
+        Publishes the MR3K2 focus; the upstream KB focus is computed on read.
+        '''
+        helper = self.pv_subscribe_helper
+        if helper.mr3k2_kbh_ds_pos is None:
+            return False
+        mr3k2_h_2, mr3k2_status = calc_focus(
+            self.registry.active['MR3K2'], None, helper.mr3k2_kbh_ds_pos,
+            FocusOutput.DOWNSTREAM, mr3k2_distance)
+        await self.write_focus(self.mr3k2_focus, mr3k2_h_2, mr3k2_status)
+        return True
+
+    async def update_mr4k2_focus(self):
+        '''
+        Publishes the MR4K2 focus; the upstream KB focus is computed on read.
+        '''
+        helper = self.pv_subscribe_helper
+        if helper.mr4k2_kbh_ds_pos is None:
+            return False
+        mr4k2_v_2, mr4k2_status = calc_focus(
+            self.registry.active['MR4K2'], None, helper.mr4k2_kbh_ds_pos,
+            FocusOutput.DOWNSTREAM, mr4k2_distance)
+        await self.write_focus(self.mr4k2_focus, mr4k2_v_2, mr4k2_status)
+        return True
+
+    async def update_mono_energy(self):
+        '''
+        Publishes the mono energy, Cff and higher orders from the pitch RBVs.
+        '''
+        helper = self.pv_subscribe_helper
+        if helper.mono_gpi_rbv is None or helper.mono_mpi_rbv is None:
+            return False
+        if self.rbv_energy.update(self.mono_geometry, helper.mono_gpi_rbv,
+                                  helper.mono_mpi_rbv):
+            await self.write_output(self.mono_e, float(self.rbv_energy.energy))
+            await self.write_output(self.cff, float(self.rbv_energy.cff))
+            await self.update_orders(self.diff_orders.value)
+        await self.mono_e_skips.write(self.rbv_energy.skipped)
+        return True
+
+    async def update_target_mono_energy(self):
+        '''
+        Publishes the target mono energy and Cff from the pitch setpoints.
+        '''
+        helper = self.pv_subscribe_helper
+        if helper.mono_gpi_sp is None or helper.mono_mpi_sp is None:
+            return False
+        if self.sp_energy.update(self.mono_geometry, helper.mono_gpi_sp,
+                                 helper.mono_mpi_sp):
+            await self.write_output(self.tar_mono_energy,
+                                    float(self.sp_energy.energy))
+            await self.write_output(self.tar_cff, float(self.sp_energy.cff))
+        await self.tar_mono_e_skips.write(self.sp_energy.skipped)
+        return True
+
+    async def update_lin_disp(self):
+        '''
+        Publishes the linear dispersion at the mono energy, or flags LIN_DISP
+        invalid when the grating does not diffract that energy.
+        '''
+        if self.local_dispersion:
+            energy = self.rbv_energy.energy
+        else:
+            energy = self.pv_subscribe_helper.mono_e
+        if energy is None:
+            return False
+        energy = float(energy)
+        try:
+            if self.dispersion_table is not None:
+                linear_dispersion = self.dispersion_table(energy)
+            else:
+                linear_dispersion = self.dispersion.lin_disp(energy)
+        except ValueError:
+            await self.lin_disp.alarm.write(
+                status=AlarmStatus.CALC,
+                severity=AlarmSeverity.INVALID_ALARM)
+            return True
+        await self.write_output(self.lin_disp, float(linear_dispersion))
+        return True
@@ -0,0 +1,201 @@
+import os
+
+import numpy as np
+import pytest
+
+from rixcalc.calibration import (BenderCalibration, CalibrationCache,
+                                 CalibrationRegistry, PchipInterpolator,
+                                 RangeStatus,
+                                 SearchInterpolator,
+                                 UniformGridInterpolator, convert_table,
+                                 find_calibrations, load_table, resolve_table)
+from rixcalc.chemrixs import mr1k1_file, mr3k2_file, mr4k2_file
+
+# Irregular table and the values of scipy.interpolate.PchipInterpolator on it
+PCHIP_XP = [0.0, 1.0, 2.5, 3.0, 4.5, 6.0]
+PCHIP_FP = [0.0, 2.0, 2.5, 4.0, 4.2, 7.0]
+PCHIP_X = [0.25, 0.5, 1.7, 2.75, 3.9, 5.2, 6.0]
+PCHIP_REFERENCE = [0.659375, 1.2583333333333335, 2.223888319088319,
+                   3.2744407788863854, 4.119220753138076, 5.033556543209877,
+                   7.000000000000001]
+
+
+@pytest.mark.parametrize('path', [mr1k1_file, mr3k2_file, mr4k2_file])
+@pytest.mark.parametrize('tolerance', [1e-3, 1e-4])
+def test_uniform_grid_matches_interp(path, tolerance):
+    q, us, ds = load_table(path)
+    rng = np.random.default_rng(0)
+    for xp in (us, ds):
+        interpolator = UniformGridInterpolator(xp, q, tolerance=tolerance)
+        assert interpolator.max_error <= tolerance
+        x = np.concatenate([xp, rng.uniform(xp[0], xp[-1], 5000)])
+        error = np.abs(interpolator.evaluate(x) - np.interp(x, xp, q))
+        # The bound is measured at the table points, where it is largest
+        assert error.max() <= interpolator.max_error + 1e-12
+        scalar = [interpolator(value) for value in x[:200]]
+        np.testing.assert_array_equal(scalar, interpolator.evaluate(x[:200]))
+
+
+@pytest.mark.parametrize('path', [mr1k1_file, mr3k2_file, mr4k2_file])
+def test_reverse_lookup_matches_interp(path):
+    q, us, ds = load_table(path)
+    calibration = BenderCalibration(q, us, ds)
+    x = np.random.default_rng(0).uniform(q[0], q[-1], 1000)
+    for reverse, column in ((calibration.q_to_us, us),
+                            (calibration.q_to_ds, ds)):
+        expected = np.interp(x, q, column)
+        np.testing.assert_allclose(reverse.evaluate(x), expected, rtol=1e-14)
+        np.testing.assert_allclose([reverse(value) for value in x],
+                                   expected, rtol=1e-14)
+
+
+def test_pchip_matches_reference():
+    interpolator = PchipInterpolator(PCHIP_XP, PCHIP_FP)
+    np.testing.assert_allclose(interpolator.evaluate(PCHIP_X),
+                               PCHIP_REFERENCE, rtol=1e-12)
+    np.testing.assert_allclose([interpolator(x) for x in PCHIP_X],
+                               PCHIP_REFERENCE, rtol=1e-12)
+    # The curve passes through every table point
+    assert interpolator.max_error < 1e-12
+
+
+@pytest.mark.parametrize('cls', [UniformGridInterpolator, PchipInterpolator,
+                                 SearchInterpolator])
+def test_out_of_range(cls):
+    interpolator = cls(PCHIP_XP, PCHIP_FP)
+    assert interpolator.lookup(-0.1)[1] == RangeStatus.BELOW_RANGE
+    assert interpolator.lookup(6.1)[1] == RangeStatus.ABOVE_RANGE
+    assert interpolator.lookup(np.nan)[1] == RangeStatus.BELOW_RANGE
+    assert np.isnan(interpolator.lookup(6.1)[0])
+    value, status = interpolator.lookup(6.0)
+    assert status == RangeStatus.OK
+    assert value == pytest.approx(7.0)
+    assert interpolator(-1.0, fill=-5.0) == -5.0
+    values = interpolator.evaluate([-1.0, 3.0, 7.0], fill=-5.0)
+    assert values[0] == values[2] == -5.0
+    assert values[1] == pytest.approx(4.0)
+
+
+@pytest.mark.parametrize('cls', [UniformGridInterpolator, PchipInterpolator,
+                                 SearchInterpolator])
+def test_rejects_unsorted_table(cls):
+    with pytest.raises(ValueError):
+        cls([0.0, 2.0, 1.0], [0.0, 1.0, 2.0])
+
+
+def test_resolve_table_uses_current_binary_only(tmp_path):
+    text = tmp_path / 'MR1K1.txt'
+    text.write_text(mr1k1_file.read_text())
+    assert resolve_table(text) == text
+    binary = convert_table(text)
+    assert resolve_table(text) == binary
+    assert find_calibrations([tmp_path], ['MR1K1']) == {
+        ('MR1K1', 'default'): binary}
+    # An edited text table takes over from its binary version
+    text.write_text(mr1k1_file.read_text() + '\n')
+    os.utime(binary, ns=(text.stat().st_mtime_ns + 10**9,) * 2)
+    assert resolve_table(text) == text
+    # As does a text table newer than the binary, even with the same content
+    convert_table(text)
+    os.utime(text, ns=(binary.stat().st_mtime_ns + 10**9,) * 2)
+    assert resolve_table(text) == text
+    text.unlink()
+    assert resolve_table(text) == binary
+
+
+def test_calibration_cache_reloads_changed_files(tmp_path):
+    path = tmp_path / 'MR1K1.txt'
+    path.write_text(mr1k1_file.read_text())
+    loads = []
+
+    def loader(path):
+        loads.append(path)
+        return len(loads)
+
+    cache = CalibrationCache(loader=loader)
+    assert cache.get(path) == cache.get(path) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    # A new modification time alone is a miss
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.get(path) == 2
+    # As is a new size, even with the modification time put back
+    path.write_text(mr1k1_file.read_text() + '\n')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.get(path) == 3
+    assert cache.get(path) == 3
+    assert (cache.hits, cache.misses) == (2, 3)
+    cache.clear()
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert cache.get(path) == 4
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_find_calibrations_ids(tmp_path):
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    for name in ('MR1K1', 'MR1K1_soft', 'MR1K1_2024.01', 'MR3K2',
+                 'MR3K2_test', 'MR4K2', 'notes'):
+        (first / f'{name}.txt').write_text('')
+    (second / 'MR3K2_test.txt').write_text('')
+    (first / 'MR1K1.csv').write_text('')
+    found = find_calibrations([first, second], ['MR1K1', 'MR3K2'])
+    assert found == {
+        ('MR1K1', 'default'): first / 'MR1K1.txt',
+        ('MR1K1', 'soft'): first / 'MR1K1_soft.txt',
+        ('MR1K1', '2024.01'): first / 'MR1K1_2024.01.txt',
+        ('MR3K2', 'default'): first / 'MR3K2.txt',
+        # Later directories take precedence
+        ('MR3K2', 'test'): second / 'MR3K2_test.txt',
+    }
+
+
+def test_registry_select_unknown_id():
+    registry = CalibrationRegistry()
+    registry.add('MR1K1', 'default', 'calibration')
+    with pytest.raises(ValueError):
+        registry.select('MR1K1', 'missing')
+    with pytest.raises(ValueError):
+        registry.select('MR3K2', 'default')
+    assert registry.active == {'MR1K1': 'calibration'}
+    assert registry.active_ids == {'MR1K1': 'default'}
+
+
+def test_registry_reload_keeps_selection():
+    paths = {('MR1K1', 'default'): 'MR1K1.txt',
+             ('MR1K1', 'soft'): 'MR1K1_soft.txt',
+             ('MR3K2', 'default'): 'MR3K2.txt',
+             ('MR3K2', 'test'): 'MR3K2_test.txt'}
+    registry = CalibrationRegistry()
+    registry.load(paths, lambda path: ('old', str(path)))
+    assert registry.active_ids == {'MR1K1': 'default', 'MR3K2': 'default'}
+    registry.select('MR1K1', 'soft')
+    registry.select('MR3K2', 'test')
+
+    def loader(path):
+        if str(path) == 'MR3K2_test.txt':
+            raise OSError('gone')
+        return ('new', str(path))
+
+    reloaded = registry.reload(loader)
+    assert reloaded.active['MR1K1'] == ('new', 'MR1K1_soft.txt')
+    # A selection that no longer loads falls back to the default
+    assert reloaded.active_ids == {'MR1K1': 'soft', 'MR3K2': 'default'}
+    assert reloaded.active['MR3K2'] == ('new', 'MR3K2.txt')
+    # The original registry is left as it was
+    assert registry.active['MR1K1'] == ('old', 'MR1K1_soft.txt')
+
+
+def test_binary_calibration_is_copied_out_of_the_file(tmp_path):
+    text = tmp_path / 'MR1K1.txt'
+    text.write_text(mr1k1_file.read_text())
+    calibration = BenderCalibration.from_file(convert_table(text))
+    assert calibration.name == 'MR1K1'
+    for column in (calibration.q, calibration.us, calibration.ds,
+                   calibration.q_to_us.xp, calibration.q_to_us.fp):
+        assert not isinstance(column, np.memmap)
+    reference = BenderCalibration.from_file(text)
+    x = np.linspace(calibration.q[0], calibration.q[-1], 100)
+    np.testing.assert_array_equal(calibration.q_to_us.evaluate(x),
+                                  reference.q_to_us.evaluate(x))
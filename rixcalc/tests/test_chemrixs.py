@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+from rixcalc.chemrixs import (MonoGeometry, get_benders, get_benders_batch,
+                              get_E, get_E_cff, get_KBs, get_KBs_batch)
+
+
+def reference_E_cff(pitchG, pitchM2):
+    '''
+    The scalar energy calculation get_E was originally written as.
+    '''
+    eVmm = 0.001239842
+    m = 1
+    D0 = 50.0
+    thetaM1 = 0.03662
+    thetaES = 0.1221413
+    offsetM2 = 90641.0e-6
+    offsetG = 63358.0e-6
+
+    pG = pitchG*1e-6 - offsetG
+    pM2 = pitchM2*1e-6 - offsetM2
+    alpha = np.pi/2 - pG + 2*pM2 - thetaM1
+    beta = -np.pi/2 - pG + thetaES
+    E = m*D0*eVmm/(np.sin(alpha) + np.sin(beta))
+    Cff = np.cos(beta)/np.cos(alpha)
+    return E, Cff
+
+
+def pitch_sweep():
+    rng = np.random.default_rng(0)
+    # From tens of eV to past 1.5 keV, and grazing to Cff ~ 5
+    pitchG = rng.uniform(60000, 130000, 2000)
+    pitchM2 = rng.uniform(80000, 140000, 2000)
+    return pitchG, pitchM2
+
+
+# MonoGeometry folds the offsets into alpha0/beta0, which rounds differently
+# from the original chain
+rtol = 2e-11
+
+
+def test_get_E_matches_reference():
+    pitchG, pitchM2 = pitch_sweep()
+    for G, M, G_sp, M_sp in zip(pitchG[:500].tolist(), pitchM2[:500].tolist(),
+                                pitchG[500:1000].tolist(),
+                                pitchM2[500:1000].tolist()):
+        E, Cff = reference_E_cff(G, M)
+        E_sp, Cff_sp = reference_E_cff(G_sp, M_sp)
+        assert get_E(G, G_sp, M, M_sp) == pytest.approx((E, E_sp), rel=rtol)
+        assert get_E_cff(G, G_sp, M, M_sp) == pytest.approx(
+            (E, E_sp, Cff, Cff_sp), rel=rtol)
+
+
+def test_mono_geometry_arrays_match_reference():
+    pitchG, pitchM2 = pitch_sweep()
+    E, Cff = reference_E_cff(pitchG, pitchM2)
+    geometry = MonoGeometry()
+    np.testing.assert_allclose(geometry.energy(pitchG, pitchM2), E,
+                               rtol=rtol)
+    np.testing.assert_allclose(geometry.energy_cff(pitchG, pitchM2),
+                               (E, Cff), rtol=rtol)
+
+
+def test_scalar_and_array_paths_agree():
+    pitchG, pitchM2 = pitch_sweep()
+    G, G_sp = pitchG[:200], pitchG[200:400]
+    M, M_sp = pitchM2[:200], pitchM2[200:400]
+    arrays = get_E_cff(G, G_sp, M, M_sp)
+    for i in range(len(G)):
+        scalars = get_E_cff(float(G[i]), float(G_sp[i]), float(M[i]),
+                            float(M_sp[i]))
+        assert all(type(value) is float for value in scalars)
+        assert scalars == pytest.approx([value[i] for value in arrays],
+                                        rel=1e-14)
+
+
+def test_kbs_batch_matches_scalar_exactly():
+    rng = np.random.default_rng(1)
+    # Ranges reach past both ends of the MR3K2 and MR4K2 tables
+    usH, dsH = (rng.uniform(13, 20, 300) for _ in range(2))
+    usV, dsV = (rng.uniform(5, 17, 300) for _ in range(2))
+    hor0, hor1, ver0, ver1, valid = get_KBs_batch(usH, dsH, usV, dsV)
+    assert valid.any() and not valid.all()
+    for i in range(len(usH)):
+        if valid[i]:
+            assert get_KBs(usH[i], dsH[i], usV[i], dsV[i]) == (
+                hor0[i], hor1[i], ver0[i], ver1[i])
+        else:
+            with pytest.raises(Exception):
+                get_KBs(usH[i], dsH[i], usV[i], dsV[i])
+
+
+def test_benders_batch_matches_scalar_exactly():
+    rng = np.random.default_rng(2)
+    # Reaches past both ends of the MR1K1 table
+    us, ds = (rng.uniform(5, 25, 300) for _ in range(2))
+    focus, valid = get_benders_batch(us, ds)
+    assert valid.any() and not valid.all()
+    for i in range(len(us)):
+        if valid[i]:
+            assert get_benders(us[i], ds[i]) == focus[i]
+        else:
+            with pytest.raises(Exception):
+                get_benders(us[i], ds[i])
+
+
+@pytest.mark.parametrize('cff', [1.5, 2.0, 5.0, 1 + 1e-4, 1 + 5e-7, 1 + 1e-7,
+                                 1 + 1e-9])
+def test_pitches_round_trip(cff):
+    geometry = MonoGeometry()
+    energy = np.linspace(100, 2000, 400)
+    pitchG, pitchM2 = geometry.pitches(energy, cff)
+    solved = np.isfinite(pitchG)
+    assert solved.any()
+    assert np.array_equal(solved, np.isfinite(pitchM2))
+    E, Cff = geometry.energy_cff(pitchG[solved], pitchM2[solved])
+    np.testing.assert_allclose(E, energy[solved], rtol=1e-9)
+    np.testing.assert_allclose(Cff, cff, rtol=1e-9)
+    for i in np.flatnonzero(solved)[::40]:
+        G, M = geometry.pitches(energy[i], cff)
+        assert get_E(G, G, M, M) == pytest.approx((energy[i],) * 2,
+                                                  rel=1e-9)
+
+
+@pytest.mark.parametrize('cff', [1.0, 0.5, 1 + 1e-13])
+def test_pitches_without_solution(cff):
+    pitchG, pitchM2 = MonoGeometry().pitches([250.0, 1000.0], cff)
+    assert np.isnan(pitchG).all() and np.isnan(pitchM2).all()
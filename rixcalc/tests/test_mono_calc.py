@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from rixcalc.gratings import default_grating
+from rixcalc.mono_calc import (DispersionTable, get_dispersion_geometry,
+                               get_dispersion_table, get_lin_disp,
+                               get_lin_disp_array)
+
+
+def test_lin_disp_array_matches_scalar():
+    energies = np.concatenate([
+        np.random.default_rng(0).uniform(250, 1600, 5000),
+        np.linspace(250, 1600, 1351),
+    ])
+    exact = np.array([get_lin_disp(E) for E in energies.tolist()])
+    np.testing.assert_allclose(get_lin_disp_array(energies), exact,
+                               rtol=1e-13)
+
+
+def test_lin_disp_array_masks_scalar_failures():
+    # No diffracted beam (beta not above 0) or no beta at all
+    failing = [0.05, 0.03, -5.0, 0.0]
+    for energy in failing:
+        with pytest.raises((ValueError, ZeroDivisionError)):
+            get_lin_disp(energy)
+    energies = np.array([250.0] + failing + [1600.0])
+    values = get_lin_disp_array(energies)
+    assert np.isnan(values[1:-1]).all()
+    assert values[0] == pytest.approx(get_lin_disp(250.0), rel=1e-13)
+    assert values[-1] == pytest.approx(get_lin_disp(1600.0), rel=1e-13)
+
+
+@pytest.mark.parametrize('tolerance', [0.0005, 0.00005])
+def test_dispersion_table_error_bound(tolerance):
+    dispersion = get_dispersion_geometry(default_grating)
+    table = DispersionTable(dispersion, tolerance=tolerance)
+    assert table.max_error <= tolerance
+    # Dense samples off the grid, including the ends of every cell
+    energies = np.concatenate([
+        np.random.default_rng(0).uniform(250, 1600, 20000),
+        np.linspace(250, 1600, 7919),
+    ])
+    exact = np.array([dispersion.lin_disp(E) for E in energies])
+    interpolated = np.array([table(E) for E in energies])
+    assert np.abs(interpolated - exact).max() <= tolerance
+
+
+def test_dispersion_table_falls_back_outside_grid():
+    table = get_dispersion_table(default_grating)
+    dispersion = table.dispersion
+    for energy in (100.0, 249.99, 1600.01, 2500.0):
+        assert table(energy) == dispersion.lin_disp(energy)
+        assert table(energy) == pytest.approx(get_lin_disp(energy),
+                                              rel=1e-12)
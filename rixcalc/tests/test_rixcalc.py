@@ -0,0 +1,291 @@
+import asyncio
+import threading
+
+import pytest
+from caproto import AlarmSeverity, AlarmStatus, ChannelType
+from caproto.asyncio.server import AsyncioAsyncLayer
+
+from rixcalc import rixcalc
+
+
+@pytest.fixture
+def ioc(monkeypatch):
+    monkeypatch.setattr(rixcalc.PvSubscribeHelper, 'subscribe',
+                        lambda self: None)
+    ioc = rixcalc.Rixcalc(prefix='TEST:RIXCALC:')
+    yield ioc
+    ioc.calibration_watcher.stop()
+
+
+async def scan_once(ioc):
+    '''
+    Runs one cycle of the CalcUpdate scan, which calls its function at once.
+    '''
+    scan = type(ioc).calc_update.pvspec.scan
+    task = asyncio.create_task(scan(ioc, ioc.calc_update,
+                                    AsyncioAsyncLayer()))
+    await asyncio.sleep(0.05)
+    task.cancel()
+
+
+def test_out_of_range_upstream_focus_stays_in_alarm(ioc):
+    async def read(pv):
+        await pv.read(ChannelType.DOUBLE)
+        return pv.alarm.status, pv.alarm.severity
+
+    pv = ioc.mr3k2_focus_us
+    ioc.pv_subscribe_helper.mr3k2_kbh_us_pos = 15.0
+    assert asyncio.run(read(pv)) == (AlarmStatus.NO_ALARM,
+                                     AlarmSeverity.NO_ALARM)
+    focus = pv.value
+    # Far past the end of the MR3K2 table
+    ioc.pv_subscribe_helper.mr3k2_kbh_us_pos = 100.0
+    assert asyncio.run(read(pv)) == (AlarmStatus.HIHI,
+                                     AlarmSeverity.INVALID_ALARM)
+    assert pv.value == focus
+    # Reading again must not clear the alarm
+    assert asyncio.run(read(pv)) == (AlarmStatus.HIHI,
+                                     AlarmSeverity.INVALID_ALARM)
+    ioc.pv_subscribe_helper.mr3k2_kbh_us_pos = 15.0
+    assert asyncio.run(read(pv)) == (AlarmStatus.NO_ALARM,
+                                     AlarmSeverity.NO_ALARM)
+
+
+@pytest.mark.parametrize('order', [('start', 'stop', 'step'),
+                                   ('step', 'stop', 'start'),
+                                   ('stop', 'step', 'start')])
+def test_scan_plan_independent_of_put_order(ioc, order):
+    values = {'start': 1000.0, 'stop': 500.0, 'step': -10.0}
+
+    async def put():
+        for name in order:
+            await getattr(ioc, f'scan_{name}').write(values[name])
+
+    asyncio.run(put())
+    assert ioc.scan_npts.value == 51
+    assert ioc.scan_npts.alarm.severity == AlarmSeverity.NO_ALARM
+    assert ioc.scan_energies.value[0] == 1000.0
+    assert ioc.scan_energies.value[-1] == 500.0
+    assert all(value == value for value in ioc.scan_gpi.value)
+
+
+def test_impossible_scan_plan_alarms(ioc):
+    async def put(name, value):
+        await getattr(ioc, name).write(value)
+
+    asyncio.run(put('scan_start', 500.0))
+    asyncio.run(put('scan_stop', 1000.0))
+    asyncio.run(put('scan_step', -10.0))
+    assert ioc.scan_npts.value == 0
+    assert ioc.scan_gpi.alarm.severity == AlarmSeverity.INVALID_ALARM
+    # Fixing the step clears the alarm
+    asyncio.run(put('scan_step', 10.0))
+    assert ioc.scan_npts.value == 51
+    assert ioc.scan_gpi.alarm.severity == AlarmSeverity.NO_ALARM
+    # No pitches reach Cff 1
+    asyncio.run(put('scan_cff', 1.0))
+    assert ioc.scan_npts.value == 51
+    assert ioc.scan_gpi.alarm.severity == AlarmSeverity.INVALID_ALARM
+
+
+def test_event_mode_recomputes_changed_inputs(ioc):
+    helper = ioc.pv_subscribe_helper
+    helper.mr1k1_bend_us_pos = helper.mr1k1_bend_ds_pos = 10.0
+
+    async def run():
+        async_lib = AsyncioAsyncLayer()
+        hooks = [type(ioc).mr1k1_focus.pvspec.startup,
+                 type(ioc).calc_mode.pvspec.startup]
+        tasks = [asyncio.create_task(hook(ioc, getattr(ioc, name), async_lib))
+                 for hook, name in zip(hooks, ('mr1k1_focus', 'calc_mode'))]
+        await asyncio.sleep(0.1)
+        assert ioc.mr1k1_focus.fields['MDEL'].value > 0
+        await ioc.calc_mode.write('Event')
+        # Concurrent recomputes are serialized
+        ioc.dependencies.mark_all_dirty()
+        await asyncio.gather(ioc.recompute(), ioc.recompute())
+        total = ioc.calc_recompute_total.value
+        # Only the MR1K1 focus has all of its inputs
+        assert total == 1
+        # A change from the CA thread wakes the recompute task
+        helper.mr1k1_bend_us_pos = 12.0
+        thread = threading.Thread(target=ioc.input_changed,
+                                  args=('mr1k1_bend_us_pos',))
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0.2)
+        for task in tasks:
+            task.cancel()
+        return total
+
+    focus = ioc.mr1k1_focus.value
+    total = asyncio.run(run())
+    assert ioc.mr1k1_focus.value != focus
+    assert ioc.calc_recomputes.value == 1
+    assert ioc.calc_recompute_total.value == total + 1
+
+
+def test_write_output_deadband(ioc):
+    pv = ioc.mono_e
+    posted = []
+
+    async def write(values, mdel, adel):
+        await pv.fields['MDEL'].write(mdel)
+        await pv.fields['ADEL'].write(adel)
+        for value in values:
+            await ioc.write_output(pv, value)
+            posted.append(pv.value)
+
+    # The smaller deadband applies
+    asyncio.run(write([500.0, 500.05, 500.2, 500.25, 500.45], 0.5, 0.1))
+    assert posted == [500.0, 500.0, 500.2, 500.2, 500.45]
+    # A negative deadband posts every value
+    posted.clear()
+    asyncio.run(write([500.46, 500.47], -1, 0.1))
+    assert posted == [500.46, 500.47]
+
+
+@pytest.mark.parametrize('position, alarm', [(100.0, AlarmStatus.HIHI),
+                                             (-100.0, AlarmStatus.LOLO)])
+def test_out_of_range_benders_alarm_in_scan(ioc, position, alarm):
+    helper = ioc.pv_subscribe_helper
+    helper.mr1k1_bend_us_pos = helper.mr1k1_bend_ds_pos = 10.0
+    helper.mr3k2_kbh_ds_pos = 15.0
+    helper.mr4k2_kbh_ds_pos = 10.0
+    helper.mono_gpi_rbv, helper.mono_mpi_rbv = 100000.0, 110000.0
+    focus_pvs = [ioc.mr1k1_focus, ioc.mr3k2_focus, ioc.mr4k2_focus]
+    asyncio.run(scan_once(ioc))
+    focus = [pv.value for pv in focus_pvs]
+    for pv in focus_pvs:
+        assert pv.alarm.severity == AlarmSeverity.NO_ALARM
+
+    helper.mr1k1_bend_us_pos = helper.mr1k1_bend_ds_pos = position
+    helper.mr3k2_kbh_ds_pos = helper.mr4k2_kbh_ds_pos = position
+    helper.mono_gpi_rbv = 101000.0
+    for name in ('mr1k1_bend_us_pos', 'mr1k1_bend_ds_pos',
+                 'mr3k2_kbh_ds_pos', 'mr4k2_kbh_ds_pos', 'mono_gpi_rbv'):
+        ioc.input_changed(name)
+    energy = ioc.mono_e.value
+    asyncio.run(scan_once(ioc))
+    for pv, value in zip(focus_pvs, focus):
+        assert (pv.alarm.status, pv.alarm.severity) == (
+            alarm, AlarmSeverity.INVALID_ALARM)
+        # The last good focus is kept
+        assert pv.value == value
+    # The mono energy is still calculated in the same cycle
+    assert ioc.mono_e.value != energy
+    assert ioc.mono_e.alarm.severity == AlarmSeverity.NO_ALARM
+
+
+def test_mono_energy_skips_repeated_rbvs(ioc):
+    helper = ioc.pv_subscribe_helper
+    helper.mono_gpi_rbv, helper.mono_mpi_rbv = 100000.0, 110000.0
+    asyncio.run(scan_once(ioc))
+    energy = ioc.mono_e.value
+    assert ioc.mono_e_skips.value == 0
+    # The same RBVs posted again
+    for skips in (1, 2):
+        ioc.input_changed('mono_gpi_rbv')
+        asyncio.run(scan_once(ioc))
+        assert ioc.mono_e_skips.value == skips
+        assert ioc.mono_e.value == energy
+    helper.mono_gpi_rbv = 101000.0
+    ioc.input_changed('mono_gpi_rbv')
+    asyncio.run(scan_once(ioc))
+    assert ioc.mono_e_skips.value == 2
+    assert ioc.mono_e.value != energy
+    assert ioc.rbv_energy.evaluations == 2
+
+
+def test_dispersion_map_rebuilt_only_after_its_inputs(ioc, monkeypatch):
+    builds = []
+    build = rixcalc.get_dispersion_map
+
+    def get_dispersion_map(*args):
+        builds.append(args)
+        return build(*args)
+
+    monkeypatch.setattr(rixcalc, 'get_dispersion_map', get_dispersion_map)
+
+    async def read_map():
+        for name in ('map_energies', 'map_cffs', 'map_lin_disp',
+                     'map_res_power'):
+            await getattr(ioc, name).read(ChannelType.DOUBLE)
+
+    async def put(name, value):
+        await getattr(ioc, name).write(value)
+
+    asyncio.run(read_map())
+    asyncio.run(read_map())
+    assert len(builds) == 1
+    # Settings the map does not depend on
+    asyncio.run(put('scan_start', 800.0))
+    asyncio.run(put('diff_orders', [1, 2]))
+    asyncio.run(read_map())
+    assert len(builds) == 1
+    for count, (name, value) in enumerate(
+            [('map_e_min', 300.0), ('map_e_max', 1500.0),
+             ('map_cff_min', 1.5), ('map_cff_max', 4.0),
+             ('map_slit_width', 20.0), ('grating', ioc.grating.value)],
+            start=2):
+        asyncio.run(put(name, value))
+        asyncio.run(read_map())
+        assert len(builds) == count
+    assert ioc.map_energies.value[0] == 300.0
+    assert ioc.map_energies.value[-1] == 1500.0
+
+
+def test_order_energies_are_multiples_of_mono_energy(ioc):
+    helper = ioc.pv_subscribe_helper
+    helper.mono_gpi_rbv, helper.mono_mpi_rbv = 100000.0, 110000.0
+    asyncio.run(scan_once(ioc))
+    energy = ioc.mono_e.value
+    assert ioc.order_mono_e.value == pytest.approx(
+        [energy, 2*energy, 3*energy], rel=1e-12)
+    assert ioc.order_lin_disp.value[0] == pytest.approx(
+        ioc.dispersion.lin_disp(energy), rel=1e-12)
+
+    async def put(value):
+        await ioc.diff_orders.write(value)
+
+    asyncio.run(put([2, 5]))
+    assert ioc.order_mono_e.value == pytest.approx(
+        [2*energy, 5*energy], rel=1e-12)
+    assert len(ioc.order_lin_disp.value) == 2
+
+
+def test_recompute_counters_written_on_change(ioc):
+    helper = ioc.pv_subscribe_helper
+    helper.mono_gpi_rbv, helper.mono_mpi_rbv = 100000.0, 110000.0
+    asyncio.run(scan_once(ioc))
+    assert ioc.calc_recomputes.value == 1
+    assert ioc.calc_recompute_total.value == 1
+    total_timestamp = ioc.calc_recompute_total.timestamp
+    asyncio.run(scan_once(ioc))
+    assert ioc.calc_recomputes.value == 0
+    assert ioc.calc_recompute_total.timestamp == total_timestamp
+    # Nothing changed, nothing to post
+    timestamp = ioc.calc_recomputes.timestamp
+    asyncio.run(scan_once(ioc))
+    assert ioc.calc_recomputes.timestamp == timestamp
+    assert ioc.calc_recompute_total.timestamp == total_timestamp
+    ioc.input_changed('mono_gpi_rbv')
+    asyncio.run(scan_once(ioc))
+    assert ioc.calc_recomputes.value == 1
+    assert ioc.calc_recompute_total.value == 2
+
+
+def test_cache_counters_written_on_change(ioc):
+    asyncio.run(scan_once(ioc))
+    assert ioc.cal_cache_misses.value == rixcalc.calibration_cache.misses
+    timestamps = (ioc.cal_cache_hits.timestamp,
+                  ioc.cal_cache_misses.timestamp)
+    asyncio.run(scan_once(ioc))
+    assert (ioc.cal_cache_hits.timestamp,
+            ioc.cal_cache_misses.timestamp) == timestamps
+    # A lookup of a table the IOC has already loaded
+    rixcalc.calibration_cache.get(ioc.registry.paths[('MR1K1', 'default')])
+    asyncio.run(scan_once(ioc))
+    assert ioc.cal_cache_hits.value == rixcalc.calibration_cache.hits
+    assert ioc.cal_cache_hits.timestamp != timestamps[0]
+    assert ioc.cal_cache_misses.timestamp == timestamps[1]
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+from rixcalc.calibration import BenderCalibration, convert_table, load_table
+from rixcalc.chemrixs import mr3k2_file
+from rixcalc.watcher import CalibrationWatcher
+
+
+def write_table(path, q, us, ds):
+    np.savetxt(path, np.column_stack([q, us, ds]))
+    # Keep the change visible on filesystems with coarse timestamps
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_edited_text_table_replaces_binary(tmp_path):
+    q, us, ds = load_table(mr3k2_file)
+    text = tmp_path / 'MR3K2.txt'
+    write_table(text, q, us, ds)
+    binary = convert_table(text)
+    loaded = []
+
+    def loader(path):
+        loaded.append(path)
+        return BenderCalibration.from_file(path)
+
+    watcher = CalibrationWatcher({('MR3K2', 'default'): binary},
+                                 loader=loader)
+    watcher.check()
+    assert watcher.pop_pending() == {}
+
+    write_table(text, q, us + 1.0, ds)
+    watcher.check()
+    calibration = watcher.pop_pending()[('MR3K2', 'default')]
+    assert loaded == [text]
+    focus = q[len(q) // 2]
+    expected = np.interp(focus, q, us + 1.0)
+    assert calibration.q_to_us(focus) == expected
+    # Nothing changed since
+    watcher.check()
+    assert watcher.pop_pending() == {}
@@ -0,0 +1,163 @@
+"""
+Background reloading of the bender calibration tables when their files change
+
+Uses inotify through the optional ``inotify_simple`` package when it is
+installed, and falls back to polling the files otherwise.
+"""
+import os
+import pathlib
+import threading
+
+from .calibration import calibration_cache, resolve_table
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _sources(path):
+    return (path.with_suffix('.txt'), path.with_suffix('.npz'))
+
+
+class CalibrationWatcher:
+    '''
+    Watches calibration files and loads new versions in a background thread.
+
+    Both the text table and its binary version are watched, and whichever
+    resolve_table picks is loaded, so an edited text table replaces a binary
+    one converted from its previous content. A changed file is parsed and
+    validated by the loader off the scan path. Tables that fail to load are
+    logged and ignored, so the running calibration stays in place.
+    Successfully loaded calibrations wait in a pending slot until the IOC
+    collects them with ``pop_pending``, which lets it swap them in between
+    two calculation cycles.
+    '''
+
+    def __init__(self, files, loader=calibration_cache.get,
+                 poll_interval=2.0):
+        self.files = {name: pathlib.Path(path) for name, path in files.items()}
+        self.loader = loader
+        self.poll_interval = poll_interval
+        self._signatures = {name: self._signature(path)
+                            for name, path in self.files.items()}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''
+        Starts watching in a daemon thread.
+        '''
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='calibration-watcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the watcher thread.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @staticmethod
+    def _signature(path):
+        return tuple(_signature(source) for source in _sources(path))
+
+    def pop_pending(self):
+        '''
+        Hands over the calibrations loaded since the last call.
+        Returns: Dictionary of mirror name to new calibration
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def reload(self):
+        '''
+        Loads every watched file again in a background thread, e.g. after
+        the loader changed what it builds. The new calibrations are handed
+        over together, so a cycle never sees a mix of old and new ones.
+        '''
+        thread = threading.Thread(target=self._reload,
+                                  name='calibration-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def _reload(self):
+        # One reload at a time, so the last one requested is installed last
+        with self._reload_lock:
+            loaded = {}
+            for name, path in self.files.items():
+                try:
+                    loaded[name] = self.loader(resolve_table(path))
+                except Exception:
+                    logger.exception('Could not reload %s calibration from '
+                                     '%s', name, path)
+            with self._lock:
+                self._pending.update(loaded)
+
+    def check(self):
+        '''
+        Reloads every watched table whose text or binary file changed in
+        modification time or size.
+        '''
+        for name, path in self.files.items():
+            signature = self._signature(path)
+            if signature == self._signatures[name]:
+                continue
+            self._signatures[name] = signature
+            path = resolve_table(path)
+            if not path.exists():
+                continue
+            try:
+                calibration = self.loader(path)
+            except Exception:
+                logger.exception('Rejected new %s calibration from %s',
+                                 name, path)
+                continue
+            logger.info('Loaded new %s calibration from %s', name, path)
+            with self._lock:
+                self._pending[name] = calibration
+
+    def _run(self):
+        if inotify_simple is not None:
+            try:
+                self._run_inotify()
+                return
+            except OSError:
+                logger.exception('inotify unavailable, polling calibration '
+                                 'files instead')
+        while not self._stop.wait(self.poll_interval):
+            self.check()
+
+    def _run_inotify(self):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        with inotify_simple.INotify() as inotify:
+            # Watch the directories so that editors replacing the file are
+            # noticed too
+            for directory in {path.parent for path in self.files.values()}:
+                inotify.add_watch(directory, mask)
+            while not self._stop.is_set():
+                if inotify.read(timeout=int(self.poll_interval * 1000)):
+                    self.check()
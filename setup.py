@@ -53,6 +53,7 @@ setup(
             # When adding files here, remember to update MANIFEST.in as well,
             # or else they will not be included in the distribution on PyPI!
             # 'path/to/data_file',
+            'MR*.txt',
             ]
         },
     install_requires=requirements,